@@ -1,345 +1,746 @@
 import asyncio
 import logging
+import logging.handlers
+import queue
+import atexit
 import json
+import math
+import random
+import statistics
+import time
 
 from datetime import datetime, timezone
+from dataclasses import dataclass
 
 import aiohttp
 
-from pybit.unified_trading import HTTP
+from prometheus_client import Counter, Histogram, start_http_server
 
 from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import ResponseError
+
+
+@dataclass(frozen=True)
+class Exchange:
+    name: str
+    label: str
+    color: str
+    url: str
+    # Path of keys/indexes to the last price in the REST response
+    price_path: tuple
+    # (path, expected value) pairs a REST response must match to be trusted
+    success: tuple = ()
+    # Path to the 24h volume in KAS, which weights the venue in the aggregate price;
+    # empty when the endpoint does not report it
+    volume_path: tuple = ()
+    interval: float = 5
+    ws_url: str | None = None
+    # A "time" key in ws_subscribe/ws_ping is replaced with the current unix time on send
+    ws_subscribe: dict | None = None
+    ws_ping: dict | str | None = None
+    ws_match: tuple = ()
+    ws_price_path: tuple = ()
+
+
+exchanges: list[Exchange] = [
+    Exchange(
+        name="bybit",
+        label="ByBit",
+        color="#2F5BE1",
+        url="https://api.bybit.com/v5/market/tickers?category=spot&symbol=KASUSDT",
+        price_path=("result", "list", 0, "lastPrice"),
+        volume_path=("result", "list", 0, "volume24h"),
+        success=((("retCode",), 0),),
+        ws_url="wss://stream.bybit.com/v5/public/spot",
+        ws_subscribe={"op": "subscribe", "args": ["tickers.KASUSDT"]},
+        ws_ping={"op": "ping"},
+        ws_match=((("topic",), "tickers.KASUSDT"),),
+        ws_price_path=("data", "lastPrice")
+    ),
+    Exchange(
+        name="kraken",
+        label="Kraken",
+        color="#1F1F1F",
+        url="https://api.kraken.com/0/public/Ticker?pair=KASUSD",
+        price_path=("result", "KASUSD", "c", 0),
+        volume_path=("result", "KASUSD", "v", 1),
+        success=((("error",), []),),
+        ws_url="wss://ws.kraken.com/v2",
+        ws_subscribe={"method": "subscribe", "params": {"channel": "ticker", "symbol": ["KAS/USD"]}},
+        ws_ping={"method": "ping"},
+        ws_match=((("channel",), "ticker"),),
+        ws_price_path=("data", 0, "last")
+    ),
+    Exchange(
+        name="kucoin",
+        label="Kucoin",
+        color="#00D1A7",
+        url="https://api.kucoin.com/api/v1/market/orderbook/level1?symbol=KAS-USDT",
+        price_path=("data", "price"),
+        success=((("code",), "200000"),)
+    ),
+    Exchange(
+        name="mexc",
+        label="Mexc",
+        color="#0C6EFF",
+        url="https://api.mexc.com/api/v3/ticker/price?symbol=KASUSDT",
+        price_path=("price",)
+    ),
+    Exchange(
+        name="coinex",
+        label="Coinex",
+        color="#1DCE72",
+        url="https://api.coinex.com/v1/market/ticker?market=KASUSDT",
+        price_path=("data", "ticker", "last"),
+        volume_path=("data", "ticker", "vol"),
+        success=((("code",), 0),)
+    ),
+    Exchange(
+        name="gate",
+        label="Gate",
+        color="#0D6EFD",
+        url="https://api.gateio.ws/api2/1/ticker/KAS_USDT",
+        price_path=("last",),
+        volume_path=("baseVolume",),
+        success=((("result",), "true"),),
+        ws_url="wss://api.gateio.ws/ws/v4/",
+        ws_subscribe={"time": 0, "channel": "spot.tickers", "event": "subscribe", "payload": ["KAS_USDT"]},
+        ws_ping={"time": 0, "channel": "spot.ping"},
+        ws_match=((("channel",), "spot.tickers"), (("event",), "update")),
+        ws_price_path=("result", "last")
+    ),
+    Exchange(
+        name="digifinex",
+        label="Digifinex",
+        color="#FF6B6B",
+        url="https://openapi.digifinex.com/v3/ticker?symbol=kas_usdt",
+        price_path=("ticker", 0, "last"),
+        volume_path=("ticker", 0, "vol"),
+        success=((("code",), 0),)
+    ),
+    Exchange(
+        name="xeggex",
+        label="Xeggex",
+        color="#F7A800",
+        url="https://api.xeggex.com/api/v2/market/info?id=251&symbol=KAS/USDT",
+        price_path=("lastPrice",)
+    ),
+    Exchange(
+        name="uphold",
+        label="Uphold",
+        color="#00C0D9",
+        url="https://api.uphold.com/v0/ticker/KAS-USD",
+        price_path=("ask",)
+    ),
+    Exchange(
+        name="bitget",
+        label="Bitget",
+        color="#3A87F7",
+        url="https://api.bitget.com/api/v2/spot/market/tickers?symbol=KASUSDT",
+        price_path=("data", 0, "lastPr"),
+        volume_path=("data", 0, "baseVolume"),
+        success=((("code",), "00000"),),
+        ws_url="wss://ws.bitget.com/v2/ws/public",
+        ws_subscribe={"op": "subscribe", "args": [{"instType": "SPOT", "channel": "ticker", "instId": "KASUSDT"}]},
+        ws_ping="ping",
+        ws_match=((("arg", "channel"), "ticker"),),
+        ws_price_path=("data", 0, "lastPr")
+    ),
+    Exchange(
+        name="lbank",
+        label="Lbank",
+        color="#FF4C00",
+        url="https://api.lbkex.com/v2/ticker.do?symbol=kas_usdt",
+        price_path=("data", 0, "ticker", "latest"),
+        volume_path=("data", 0, "ticker", "vol"),
+        success=((("result",), "true"),)
+    ),
+    Exchange(
+        name="bydfi",
+        label="Bydfi",
+        color="#FF5B00",
+        url="https://www.bydfi.com/b2b/rank/orderbook?market_pair=KAS_USDT&depth=1",
+        price_path=("asks", 0, "price"),
+        success=((("code",), 200),)
+    ),
+    Exchange(
+        name="btse",
+        label="Btse",
+        color="#FF3366",
+        url="https://api.btse.com/spot/api/v3.2/price?symbol=KAS-USDT",
+        price_path=(0, "lastPrice")
+    )
+]
 
 
-class ByBit:
-    @staticmethod
-    async def get_kas_last_price() -> list:
-        data: list = ["bybit", None]
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
 
-        try:
-            session: HTTP = HTTP(
-                testnet=False,
-                api_key="wbpRq2SeFQ5S45OS7c",
-                api_secret="BtpsYppPwwTN5daS5M0CXT08nHZS4H7xguTh",
-            )
-
-            result: dict = session.get_tickers(
-                category="spot",
-                symbol="KASUSDT",
-            )
-
-            if result["retCode"] == 0:
-                data[1] = float(result["result"]["list"][0]["lastPrice"])
-            else:
-                app_logger.error(f"Bybit error")
-        except Exception as exc:
-            app_logger.error(f"Bybit error: {exc}")
+        if getattr(record, "repeated", 0):
+            entry["repeated"] = record.repeated
 
-        return data
+        return json.dumps(entry, ensure_ascii=False)
 
 
-class Kraken:
+class RepeatSampler(logging.Filter):
+    """Passes a repeated warning or error once per window, with the count of dropped repeats."""
+
+    def __init__(self, window: float, max_keys: int = 10000):
+        super().__init__()
+        self.window: float = window
+        self.max_keys: int = max_keys
+        # Sampling key (see get_key) -> [time.monotonic() of the last pass, dropped since]
+        self.seen: dict[tuple, list] = {}
+
     @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.kraken.com/0/public/Ticker?pair=KASUSD"
-        data: list = ["kraken", None]
+    def get_key(record: logging.LogRecord) -> tuple:
+        # The call site rather than the message, which usually embeds per-attempt
+        # detail (ids, URLs, exception reprs) and would never repeat. A log call
+        # shared by several subjects passes extra={"sample_key": ...} to keep them apart.
+        return (
+            record.name,
+            record.levelno,
+            record.pathname,
+            record.lineno,
+            record.exc_info[0] if record.exc_info else None,
+            getattr(record, "sample_key", None)
+        )
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+
+        key: tuple = self.get_key(record)
+        now: float = time.monotonic()
+        seen: list | None = self.seen.get(key)
+
+        if seen is not None and now - seen[0] < self.window:
+            seen[1] += 1
+            return False
+
+        if seen is not None:
+            record.repeated = seen[1]
+        elif len(self.seen) >= self.max_keys:
+            self.seen.clear()
+
+        self.seen[key] = [now, 0]
+        return True
+
+
+config: dict = {
+    "ws_frame_version": 1,
+    "updates_stream_key": "updates",
+    "updates_stream_maxlen": 10000,
+    "kas_rates_history_retention": 30 * 24 * 60 * 60 * 1000,
+    "kas_rates_publish_interval": 5,
+    "kas_rates_keyframe_interval": 60,
+    "kas_rate_stale_after": 30,
+    "exchange_max_backoff": 120,
+    "http_limit": 100,
+    "http_limit_per_host": 4,
+    "http_dns_cache_ttl": 300,
+    "http_keepalive_timeout": 60,
+    "kas_rates_max_publish_rate": 2,
+    "stream_ping_interval": 15,
+    "stream_receive_timeout": 45,
+    "stream_stale_after": 30,
+    "kas_aggregate_outlier_threshold": 0.02,
+    "metrics_port": 9101,
+    "log_max_bytes": 10 * 1024 * 1024,
+    "log_backup_count": 5,
+    "log_sample_window": 60
+}
+
+# Handlers do their I/O on the listener thread, the event loop only puts records on a queue
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+queue_handler: logging.handlers.QueueHandler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(RepeatSampler(config["log_sample_window"]))
+# QueueHandler merges the traceback into the message before enqueueing, so the
+# JSON formatter never sees exc_info; "%(message)s" keeps basicConfig from adding its own format
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+file_handler: logging.handlers.RotatingFileHandler = logging.handlers.RotatingFileHandler(
+    "app.log",
+    maxBytes=config["log_max_bytes"],
+    backupCount=config["log_backup_count"],
+    encoding="utf-8"
+)
+console_handler: logging.StreamHandler = logging.StreamHandler()
 
-        try:
-            result: dict = await fetch(session, url)
-            if result["error"]:
-                app_logger.error("Kraken error")
-            else:
-                data[1] = float(result["result"]["KASUSD"]["c"][0])
-        except Exception as exc:
-            app_logger.error(f"Kraken error: {exc}")
+file_handler.setLevel(logging.INFO)
+console_handler.setLevel(logging.DEBUG)
 
-        return data
+file_handler.setFormatter(JSONFormatter())
+console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s: %(name)s %(message)s"))
 
+log_listener: logging.handlers.QueueListener = logging.handlers.QueueListener(
+    log_queue, file_handler, console_handler, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
 
-class Kucoin:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.kucoin.com/api/v1/market/orderbook/level1?symbol=KAS-USDT"
-        data: list = ["kucoin", None]
+# Library loggers (aiohttp, redis) go through the same queue
+logging.basicConfig(level=logging.WARNING, handlers=[queue_handler])
 
-        try:
-            result: dict = await fetch(session, url)
-            if result["code"] == "200000":
-                data[1] = float(result["data"]["price"])
-            else:
-                app_logger.error("Kucoin error")
-        except Exception as exc:
-            app_logger.error(f"Kucoin error: {exc}")
+app_logger: logging.Logger = logging.getLogger("app_logger")
+app_logger.setLevel(logging.DEBUG)
+app_logger.addHandler(queue_handler)
+app_logger.propagate = False
 
-        return data
+redis_client: Redis = Redis(host="redis-server", decode_responses=True)
+kas_rates_history_keys: set[str] = set()
+
+# Exchange name -> (last price, time.monotonic() of the fetch)
+kas_rates: dict[str, tuple[float, float]] = {}
+kas_rates_changed: asyncio.Event = asyncio.Event()
+# Exchange name -> last 24h volume in KAS from its REST ticker; kept while the venue
+# streams, the volume moves far slower than the price
+kas_volumes: dict[str, float] = {}
+kas_rates_history_saved_at: float = 0
+
+# Last state broadcast to clients, deltas are computed against it
+kas_rates_sent: dict[str, float | None] = {}
+kas_rates_keyframe_at: float = 0
+
+# Exchange name -> time.monotonic() of the last message on a stream that has delivered a price
+streams_seen: dict[str, float] = {}
+
+exchange_fetch_seconds: Histogram = Histogram(
+    "exchange_fetch_seconds", "REST ticker request latency", ["exchange"],
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+exchange_fetch_errors: Counter = Counter(
+    "exchange_fetch_errors", "Failed REST ticker requests", ["exchange", "reason"]
+)
+exchange_stream_messages: Counter = Counter(
+    "exchange_stream_messages", "Prices received over exchange websockets", ["exchange"]
+)
+exchange_stream_errors: Counter = Counter(
+    "exchange_stream_errors", "Dropped exchange websocket connections", ["exchange"]
+)
+kas_rates_publish_seconds: Histogram = Histogram(
+    "kas_rates_publish_seconds", "Time to publish kas-rates and the aggregate to Redis"
+)
 
 
-class Mexc:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.mexc.com/api/v3/ticker/price?symbol=KASUSDT"
-        data: list = ["mexc", None]
+def build_frame(method: str, data: str) -> str:
+    return f'{{"v":{config["ws_frame_version"]},"method":{json.dumps(method)},"data":{data}}}'
 
-        try:
-            result: dict = await fetch(session, url)
-            data[1] = float(result["price"])
-        except Exception as exc:
-            app_logger.error(f"Mexc error: {exc}")
 
-        return data
+def publish_update(pipe: Pipeline, topic: str, frame: str):
+    # A capped stream instead of PUBLISH: the entry id becomes the event id the
+    # websocket clients resume from, and a burst waits in the stream for the readers.
+    pipe.xadd(
+        config["updates_stream_key"],
+        {"topic": topic, "frame": frame},
+        maxlen=config["updates_stream_maxlen"],
+        approximate=True
+    )
 
 
-class Coinex:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.coinex.com/v1/market/ticker?market=KASUSDT"
-        data: list = ["coinex", None]
+async def create_history_key(key: str, labels: dict):
+    if key in kas_rates_history_keys:
+        return
 
-        try:
-            result: dict = await fetch(session, url)
+    try:
+        await redis_client.ts().create(
+            key,
+            retention_msecs=config["kas_rates_history_retention"],
+            duplicate_policy="last",
+            labels=labels
+        )
+    except ResponseError:
+        # Already created by a previous run
+        pass
+
+    kas_rates_history_keys.add(key)
+
+
+async def save_kas_rates_history(rates: list[list], aggregate: dict | None, timestamp: int):
+    samples: list[tuple[str, int, float]] = []
+
+    for name, price in rates:
+        if price is None:
+            continue
+
+        key: str = f"kas-rates-history:{name}"
+        await create_history_key(key, {"type": "kas-rate", "exchange": name})
+        samples.append((key, timestamp, price))
+
+    if aggregate is not None:
+        for field in ("price", "median", "spread"):
+            key = f"kas-aggregate-history:{field}"
+            await create_history_key(key, {"type": "kas-aggregate", "field": field})
+            samples.append((key, timestamp, aggregate[field]))
+
+    if samples:
+        await redis_client.ts().madd(samples)
+
+
+def get_kas_aggregate(rates: list[list], timestamp: int) -> dict | None:
+    fresh: list[list] = [rate for rate in rates if rate[1] is not None]
+
+    if not fresh:
+        return None
+
+    median: float = statistics.median(price for _, price in fresh)
+    inliers: list[list] = []
+    outliers: list[str] = []
+
+    for name, price in fresh:
+        if median and abs(price - median) / median > config["kas_aggregate_outlier_threshold"]:
+            outliers.append(name)
+        else:
+            inliers.append([name, price])
+
+    # With every venue far from the median there is nothing to trust more than the rest
+    if not inliers:
+        inliers, outliers = fresh, []
+
+    # The reference price weights the inliers by 24h volume. A venue whose volume is
+    # unknown counts as a typical one (the median known volume), and with no volume
+    # known at all every venue weighs the same.
+    volumes: list[float] = [kas_volumes[name] for name, _ in inliers if name in kas_volumes]
+    default_weight: float = statistics.median(volumes) if volumes else 1
+    weights: list[float] = [kas_volumes.get(name, default_weight) for name, _ in inliers]
+
+    prices: list[float] = [price for _, price in fresh]
+    inlier_prices: list[float] = [price for _, price in inliers]
+
+    return {
+        "timestamp": timestamp,
+        "price": sum(weight * price for weight, (_, price) in zip(weights, inliers)) / sum(weights),
+        "median": median,
+        # Across every fresh venue, outliers included: the divergence is the point
+        "min": min(prices),
+        "max": max(prices),
+        "spread": (max(prices) - min(prices)) / median * 100 if median else 0,
+        "inlier_spread": (max(inlier_prices) - min(inlier_prices)) / median * 100 if median else 0,
+        "venues": len(inliers),
+        "volume_weighted": len(volumes),
+        "stale": [name for name, price in rates if price is None],
+        "outliers": outliers
+    }
 
-            if result["code"] == 0:
-                data[1] = float(result["data"]["ticker"]["last"])
-            else:
-                app_logger.error("Coinex error")
-        except Exception as exc:
-            app_logger.error(f"Coinex error: {exc}")
 
-        return data
+async def fetch(session, url):
+    headers: dict = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+                      " (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
+        "Accept": "application/json",
+    }
 
+    try:
+        async with session.get(url, headers=headers, ssl=False) as response:
+            response.raise_for_status()
 
-class Gate:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.gateio.ws/api2/1/ticker/KAS_USDT"
-        data: list = ["gate", None]
+            if response.content_type == "text/plain":
+                return json.loads(await response.text())
+            return await response.json()
+    except asyncio.TimeoutError:
+        app_logger.error(f"Timeout {url}", extra={"sample_key": url})
+    except Exception as e:
+        app_logger.error(f"Unknown error {url}: {e}", extra={"sample_key": url})
 
-        try:
-            result: dict = await fetch(session, url)
 
-            if result["result"] == "true":
-                data[1] = float(result["last"])
-            else:
-                app_logger.error("Gate error")
-        except Exception as exc:
-            app_logger.error(f"Gate error: {exc}")
+def get_path(data, path: tuple):
+    for key in path:
+        data = data[key]
+    return data
 
-        return data
 
+def parse_price(data, conditions: tuple, price_path: tuple) -> float | None:
+    for path, expected in conditions:
+        if get_path(data, path) != expected:
+            return None
 
-class Digifinex:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://openapi.digifinex.com/v3/ticker?symbol=kas_usdt"
-        data: list = ["digifinex", None]
+    return float(get_path(data, price_path))
 
-        try:
-            result: dict = await fetch(session, url)
 
-            if result["code"] == 0:
-                data[1] = float(result["ticker"][0]["last"])
-            else:
-                app_logger.error("Digifinex error")
-        except Exception as exc:
-            app_logger.error(f"Digifinex error: {exc}")
+def parse_volume(data, volume_path: tuple) -> float | None:
+    if not volume_path:
+        return None
 
-        return data
+    try:
+        volume: float = float(get_path(data, volume_path))
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
 
+    return volume if math.isfinite(volume) and volume > 0 else None
 
-class Xeggex:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.xeggex.com/api/v2/market/info?id=251&symbol=KAS/USDT"
-        data: list = ["xeggex", None]
 
-        try:
-            result: dict = await fetch(session, url)
-            data[1] = float(result["lastPrice"])
-        except Exception as exc:
-            app_logger.error(f"Xeggex error: {exc}")
+def with_time(message: dict | str) -> dict | str:
+    if isinstance(message, dict) and "time" in message:
+        return {**message, "time": int(time.time())}
+    return message
 
-        return data
 
+async def get_kas_last_price(exchange: Exchange, session: aiohttp.ClientSession) -> float | None:
+    try:
+        with exchange_fetch_seconds.labels(exchange.name).time():
+            result = await fetch(session, exchange.url)
 
-class Uphold:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.uphold.com/v0/ticker/KAS-USD"
-        data: list = ["uphold", None]
+        if result is None:
+            exchange_fetch_errors.labels(exchange.name, "request").inc()
+            return None
 
-        try:
-            result: dict = await fetch(session, url)
-            data[1] = float(result["ask"])
-        except Exception as exc:
-            app_logger.error(f"Uphold error: {exc}")
+        price: float | None = parse_price(result, exchange.success, exchange.price_path)
+        if price is None:
+            exchange_fetch_errors.labels(exchange.name, "rejected").inc()
+            app_logger.error(f"{exchange.label} error", extra={"sample_key": exchange.name})
+            return None
 
-        return data
+        volume: float | None = parse_volume(result, exchange.volume_path)
+        if volume is not None:
+            kas_volumes[exchange.name] = volume
 
+        return price
+    except Exception as exc:
+        exchange_fetch_errors.labels(exchange.name, "parse").inc()
+        app_logger.error(f"{exchange.label} error: {exc!r}", extra={"sample_key": exchange.name})
 
-class Bitget:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.bitget.com/api/v2/spot/market/tickers?symbol=KASUSDT"
-        data: list = ["bitget", None]
 
-        try:
-            result: dict = await fetch(session, url)
+def set_kas_rate(name: str, price: float):
+    previous: tuple[float, float] | None = kas_rates.get(name)
+    kas_rates[name] = (price, time.monotonic())
 
-            if result["code"] == "00000":
-                data[1] = float(result["data"][0]["lastPr"])
-            else:
-                app_logger.error("Bitget error")
-        except Exception as exc:
-            app_logger.error(f"Bitget error: {exc}")
+    if previous is None or previous[0] != price:
+        kas_rates_changed.set()
 
-        return data
 
+def is_streaming(name: str) -> bool:
+    seen: float | None = streams_seen.get(name)
+    return seen is not None and time.monotonic() - seen <= config["stream_stale_after"]
 
-class Lbank:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.lbkex.com/v2/ticker.do?symbol=kas_usdt"
-        data: list = ["lbank", None]
 
-        try:
-            result: dict = await fetch(session, url)
+async def ping_stream(exchange: Exchange, ws: aiohttp.ClientWebSocketResponse):
+    while True:
+        await asyncio.sleep(config["stream_ping_interval"])
 
-            if result["result"] == "true":
-                data[1] = float(result["data"][0]["ticker"]["latest"])
-            else:
-                app_logger.error("Lbank error")
+        ping: dict | str = with_time(exchange.ws_ping)
+        if isinstance(ping, str):
+            await ws.send_str(ping)
+        else:
+            await ws.send_json(ping)
+
+
+async def stream_exchange(exchange: Exchange, session: aiohttp.ClientSession):
+    name: str = exchange.name
+    failures: int = 0
+
+    while True:
+        try:
+            async with session.ws_connect(
+                    exchange.ws_url,
+                    ssl=False,
+                    receive_timeout=config["stream_receive_timeout"]
+            ) as ws:
+                await ws.send_json(with_time(exchange.ws_subscribe))
+                pinger: asyncio.Task = asyncio.create_task(ping_stream(exchange, ws))
+
+                try:
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            continue
+
+                        try:
+                            price: float | None = parse_price(
+                                json.loads(msg.data),
+                                exchange.ws_match,
+                                exchange.ws_price_path
+                            )
+                        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                            # Plain text pongs and messages of other shapes
+                            price = None
+
+                        if price is not None:
+                            exchange_stream_messages.labels(name).inc()
+                            failures = 0
+                            set_kas_rate(name, price)
+                            streams_seen[name] = time.monotonic()
+                        elif name in streams_seen:
+                            streams_seen[name] = time.monotonic()
+                finally:
+                    pinger.cancel()
         except Exception as exc:
-            app_logger.error(f"Lbank error: {exc}")
+            exchange_stream_errors.labels(name).inc()
+            app_logger.error(f"{exchange.label} stream error: {exc!r}", extra={"sample_key": exchange.name})
 
-        return data
+        # REST polling takes over until the stream delivers a price again
+        streams_seen.pop(name, None)
 
+        failures += 1
+        delay: float = min(config["exchange_max_backoff"], 2 ** failures)
+        await asyncio.sleep(random.uniform(delay / 2, delay))
 
-class Bydfi:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://www.bydfi.com/b2b/rank/orderbook?market_pair=KAS_USDT&depth=1"
-        data: list = ["bydfi", None]
 
-        try:
-            result: dict = await fetch(session, url)
+async def poll_exchange(exchange: Exchange, session: aiohttp.ClientSession):
+    name: str = exchange.name
+    interval: float = exchange.interval
+    failures: int = 0
 
-            if result["code"] == 200:
-                data[1] = float(result["asks"][0]["price"])
-            else:
-                app_logger.error("Bydfi error")
-        except Exception as exc:
-            app_logger.error(f"Bydfi error: {exc}")
+    while True:
+        if is_streaming(name):
+            await asyncio.sleep(interval)
+            continue
 
-        return data
+        price: float | None = await get_kas_last_price(exchange, session)
 
+        if price is None:
+            # Jittered exponential backoff keeps a failing venue from being hammered
+            failures += 1
+            delay: float = min(config["exchange_max_backoff"], interval * 2 ** failures)
+            delay = random.uniform(delay / 2, delay)
+        else:
+            failures = 0
+            set_kas_rate(name, price)
+            delay = interval
 
-class Btse:
-    @staticmethod
-    async def get_kas_last_price(session: aiohttp.ClientSession) -> list:
-        url: str = "https://api.btse.com/spot/api/v3.2/price?symbol=KAS-USDT"
-        data: list = ["btse", None]
+        await asyncio.sleep(delay)
 
-        try:
-            result: dict = await fetch(session, url)
-            data[1] = float(result[0]["lastPrice"])
-        except Exception as exc:
-            app_logger.error(f"Btse error: {exc}")
 
-        return data
+def get_kas_rates() -> list[list]:
+    now: float = time.monotonic()
+    rates: list[list] = []
 
+    for exchange in exchanges:
+        name: str = exchange.name
+        rate: tuple[float, float] | None = kas_rates.get(name)
 
-logging.basicConfig(
-    filename="app.log",
-    format="[%(levelname)s] %(asctime)s: %(name)s %(message)s",
-    level=logging.WARNING
-)
+        if rate is None or (now - rate[1] > config["kas_rate_stale_after"] and not is_streaming(name)):
+            rates.append([name, None])
+        else:
+            rates.append([name, rate[0]])
 
-app_logger: logging.Logger = logging.getLogger("app_logger")
-file_handler: logging.FileHandler = logging.FileHandler("app.log")
-console_handler: logging.StreamHandler = logging.StreamHandler()
-formatter: logging.Formatter = logging.Formatter("[%(levelname)s] %(asctime)s: %(name)s %(message)s")
+    return rates
 
-app_logger.setLevel(logging.DEBUG)
-file_handler.setLevel(logging.INFO)
-console_handler.setLevel(logging.DEBUG)
 
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+async def publish_kas_rates():
+    global kas_rates_sent, kas_rates_keyframe_at, kas_rates_history_saved_at
 
-app_logger.addHandler(file_handler)
-app_logger.addHandler(console_handler)
+    rates: list[list] = get_kas_rates()
+    timestamp: int = int(datetime.now(timezone.utc).timestamp() * 1000)
+    now: float = time.monotonic()
 
-app_logger.propagate = False
+    keyframe: bool = now - kas_rates_keyframe_at >= config["kas_rates_keyframe_interval"]
+    changed: list[list] = [
+        [name, price] for name, price in rates
+        if name not in kas_rates_sent or kas_rates_sent[name] != price
+    ]
+    aggregate: dict | None = get_kas_aggregate(rates, timestamp)
 
-redis_client: Redis = Redis(host="redis-server", decode_responses=True)
+    # Only venues whose price moved are broadcast, with a full keyframe now and then for resync
+    if keyframe or changed:
+        result: str = json.dumps({
+            "data": rates,
+            "timestamp": timestamp
+        }, separators=(",", ":"))
 
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set("kas-rates", result)
 
-async def fetch(session, url):
-    headers: dict = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-                      " (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36",
-        "Accept": "application/json",
-    }
+            if keyframe:
+                publish_update(pipe, "rates", build_frame("kas-rates", result))
+            else:
+                publish_update(pipe, "rates", build_frame("kas-rates-delta", json.dumps({
+                    "data": changed,
+                    "timestamp": timestamp
+                }, separators=(",", ":"))))
+
+            if aggregate is not None:
+                aggregate_json: str = json.dumps(aggregate, separators=(",", ":"))
+                pipe.set("kas-aggregate", aggregate_json)
+                publish_update(pipe, "aggregate", build_frame("kas-aggregate", aggregate_json))
+
+            await pipe.execute()
+
+        kas_rates_sent = {name: price for name, price in rates}
+        if keyframe:
+            kas_rates_keyframe_at = now
+
+    # Streams can publish more often than the history resolution
+    if now - kas_rates_history_saved_at < config["kas_rates_publish_interval"]:
+        return
+    kas_rates_history_saved_at = now
 
     try:
-        async with session.get(url, headers=headers, ssl=False) as response:
-            response.raise_for_status()
+        await save_kas_rates_history(rates, aggregate, timestamp)
+    except Exception as exc:
+        app_logger.error(f"Save kas-rates history error: {exc}")
 
-            if response.content_type == "text/plain":
-                return json.loads(await response.text())
-            return await response.json()
-    except asyncio.TimeoutError:
-        app_logger.error(f"Timeout {url}")
-    except Exception as e:
-        app_logger.error(f"Unknown error {url}: {e}")
+
+async def publish_exchanges():
+    await redis_client.set("kas-exchanges", json.dumps([
+        {"name": exchange.name, "label": exchange.label, "color": exchange.color}
+        for exchange in exchanges
+    ], separators=(",", ":")))
+
+
+async def publish_kas_rates_loop():
+    while True:
+        # Publish as soon as a price changes, but at most kas_rates_max_publish_rate
+        # times per second, and at least every kas_rates_publish_interval
+        try:
+            await asyncio.wait_for(kas_rates_changed.wait(), config["kas_rates_publish_interval"])
+        except asyncio.TimeoutError:
+            pass
+        kas_rates_changed.clear()
+
+        try:
+            with kas_rates_publish_seconds.time():
+                await publish_kas_rates()
+        except Exception as exc:
+            app_logger.error(f"Publish kas-rates error: {exc}")
+
+        await asyncio.sleep(1 / config["kas_rates_max_publish_rate"])
 
 
 async def main():
+    start_http_server(config["metrics_port"])
+
     while await redis_client.get("fastapi-core-ready") is None:
         await asyncio.sleep(1)
 
     app_logger.info("App starting..")
 
+    await publish_exchanges()
+
     timeout: aiohttp.ClientTimeout = aiohttp.ClientTimeout(
         total=10,
         connect=5,
         sock_connect=5,
         sock_read=5
     )
+    connector: aiohttp.TCPConnector = aiohttp.TCPConnector(
+        limit=config["http_limit"],
+        limit_per_host=config["http_limit_per_host"],
+        ttl_dns_cache=config["http_dns_cache_ttl"],
+        keepalive_timeout=config["http_keepalive_timeout"]
+    )
 
-    while True:
-        app_logger.info("Requests are being sent")
-
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            tasks: list = [
-                ByBit.get_kas_last_price(),
-                Kraken.get_kas_last_price(session),
-                Kucoin.get_kas_last_price(session),
-                Mexc.get_kas_last_price(session),
-                Coinex.get_kas_last_price(session),
-                Gate.get_kas_last_price(session),
-                Digifinex.get_kas_last_price(session),
-                Xeggex.get_kas_last_price(session),
-                Uphold.get_kas_last_price(session),
-                Bitget.get_kas_last_price(session),
-                Lbank.get_kas_last_price(session),
-                Bydfi.get_kas_last_price(session),
-                Btse.get_kas_last_price(session)
-            ]
-            result: str = json.dumps({
-                "data": await asyncio.gather(*tasks),
-                "timestamp": int(datetime.now(timezone.utc).timestamp() * 1000)
-            })
-
-            data: str = json.dumps({
-                "method": "kas-rates",
-                "data": result
-            })
-
-            await redis_client.set("kas-rates", result)
-            await redis_client.publish("updates", data)
-
-        await asyncio.sleep(5)
-
-
-asyncio.run(main())
+    # One session for the whole run keeps DNS, TCP and TLS state between polls
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        pollers: list[asyncio.Task] = [
+            asyncio.create_task(poll_exchange(exchange, session)) for exchange in exchanges
+        ]
+        pollers += [
+            asyncio.create_task(stream_exchange(exchange, session))
+            for exchange in exchanges if exchange.ws_url is not None
+        ]
+
+        try:
+            await publish_kas_rates_loop()
+        finally:
+            for poller in pollers:
+                poller.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
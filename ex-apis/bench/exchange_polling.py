@@ -0,0 +1,109 @@
+"""
+Polls every registered exchange against a local server that answers slowly, and
+measures event loop lag meanwhile; fails when the worst lag is over the threshold:
+
+    python bench/exchange_polling.py --delay 2 --duration 10 --max-lag 0.05
+
+Each venue's URL is pointed at the server, which replies with the venue's REST
+fixture from bench/exchanges.py after --delay seconds. A blocking request anywhere
+in the polling path stalls the loop for the whole delay and fails the run.
+"""
+import argparse
+import asyncio
+import dataclasses
+import os
+import statistics
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import main as app  # noqa: E402
+from exchanges import REST_FIXTURES  # noqa: E402
+
+
+def percentile(values: list[float], q: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(len(values) * q))]
+
+
+def create_venues(delay: float) -> web.Application:
+    async def ticker(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        return web.json_response(REST_FIXTURES[request.match_info["name"]])
+
+    venues: web.Application = web.Application()
+    venues.router.add_get("/{name}", ticker)
+
+    return venues
+
+
+async def measure_lag(samples: list[float], interval: float):
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+    while True:
+        started_at: float = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - started_at - interval)
+
+
+async def run(args: argparse.Namespace):
+    server: TestServer = TestServer(create_venues(args.delay))
+    await server.start_server()
+
+    exchanges: list[app.Exchange] = [
+        dataclasses.replace(exchange, url=str(server.make_url(f"/{exchange.name}")), interval=args.interval)
+        for exchange in app.exchanges
+    ]
+    lag: list[float] = []
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=args.delay + 5)) as session:
+        tasks: list[asyncio.Task] = [asyncio.create_task(measure_lag(lag, args.sample_interval))]
+        tasks += [asyncio.create_task(app.poll_exchange(exchange, session)) for exchange in exchanges]
+
+        started_at: float = time.monotonic()
+        await asyncio.sleep(args.duration)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    await server.close()
+
+    polled: list[str] = [
+        exchange.name for exchange in exchanges
+        if exchange.name in app.kas_rates and app.kas_rates[exchange.name][1] >= started_at
+    ]
+
+    print(f"{'venues polled':<20}{len(polled):>10}/{len(exchanges)}")
+    print(f"{'lag p50, ms':<20}{statistics.median(lag) * 1000:>10.1f}")
+    print(f"{'lag p99, ms':<20}{percentile(lag, 0.99) * 1000:>10.1f}")
+    print(f"{'lag max, ms':<20}{max(lag) * 1000:>10.1f}")
+
+    if len(polled) < len(exchanges):
+        raise SystemExit(f"Not polled: {sorted({exchange.name for exchange in exchanges} - set(polled))}")
+
+    if max(lag) > args.max_lag:
+        raise SystemExit(f"Event loop lag {max(lag) * 1000:.1f}ms is over {args.max_lag * 1000:.0f}ms")
+
+
+def main():
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=2)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--interval", type=float, default=0.5)
+    parser.add_argument("--sample-interval", type=float, default=0.01)
+    parser.add_argument("--max-lag", type=float, default=0.05)
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.duration <= args.delay:
+        parser.error("--duration must be longer than --delay")
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
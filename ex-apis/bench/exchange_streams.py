@@ -0,0 +1,248 @@
+"""
+Runs stream_exchange and poll_exchange for one venue against a local server that
+plays its websocket and REST APIs, and checks the failover between them:
+
+    python bench/exchange_streams.py --exchange bybit
+
+- the subscribe message is sent and streamed prices are parsed;
+- while the stream is up the REST poller stays idle;
+- a dropped stream is reconnected with jittered exponential backoff, meanwhile
+  streams_seen is cleared and the REST poller takes over;
+- a burst of price changes is published at most kas_rates_max_publish_rate times
+  a second (publish_kas_rates is replaced by a counter, nothing goes to Redis).
+"""
+import argparse
+import asyncio
+import copy
+import dataclasses
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import main as app  # noqa: E402
+from exchanges import REST_FIXTURES, STREAM_FIXTURES  # noqa: E402
+
+# Slack for scheduling on top of the expected delays, seconds
+SLACK: float = 0.5
+
+
+class Venue:
+    def __init__(self, exchange: app.Exchange):
+        self.exchange: app.Exchange = exchange
+        self.price: float = 0.1
+        self.accepting: bool = True
+        self.dropped: asyncio.Event = asyncio.Event()
+        # time.monotonic() of every websocket connection attempt and REST request
+        self.connects: list[float] = []
+        self.rest_requests: list[float] = []
+        self.subscriptions: list = []
+        self.sent: int = 0
+
+    def get_message(self) -> dict:
+        message: dict = copy.deepcopy(STREAM_FIXTURES[self.exchange.name])
+
+        target = message
+        for key in self.exchange.ws_price_path[:-1]:
+            target = target[key]
+        target[self.exchange.ws_price_path[-1]] = f"{self.price:.8f}"
+
+        return message
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        self.connects.append(time.monotonic())
+        if not self.accepting:
+            return web.Response(status=503)
+
+        ws: web.WebSocketResponse = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.subscriptions.append(await ws.receive_json(timeout=5))
+
+        # A new price every 10ms until the test drops the connection
+        try:
+            while not self.dropped.is_set():
+                self.price += 0.00001
+                await ws.send_json(self.get_message())
+                self.sent += 1
+                await asyncio.sleep(0.01)
+        except ConnectionResetError:
+            pass
+
+        await ws.close()
+        return ws
+
+    async def rest(self, request: web.Request) -> web.Response:
+        self.rest_requests.append(time.monotonic())
+        return web.json_response(REST_FIXTURES[self.exchange.name])
+
+
+def without_time(message: dict | str) -> dict | str:
+    # with_time() stamps the send time in, it can't match the registry value
+    if isinstance(message, dict):
+        return {key: value for key, value in message.items() if key != "time"}
+    return message
+
+
+async def wait_for(condition, timeout: float, error: str):
+    deadline: float = time.monotonic() + timeout
+
+    while not condition():
+        if time.monotonic() > deadline:
+            raise SystemExit(error)
+        await asyncio.sleep(0.01)
+
+
+def check(passed: bool, name: str, detail: str):
+    print(f"{'ok' if passed else 'FAIL':<6}{name:<40}{detail}")
+    if not passed:
+        raise SystemExit(f"{name}: {detail}")
+
+
+async def run(args: argparse.Namespace):
+    registry: dict[str, app.Exchange] = {exchange.name: exchange for exchange in app.exchanges}
+    if registry.get(args.exchange) is None or registry[args.exchange].ws_url is None:
+        raise SystemExit(f"{args.exchange}: not a streaming exchange")
+
+    venue: Venue = Venue(registry[args.exchange])
+    venues: web.Application = web.Application()
+    venues.router.add_get("/stream", venue.stream)
+    venues.router.add_get("/rest", venue.rest)
+
+    server: TestServer = TestServer(venues)
+    await server.start_server()
+
+    exchange: app.Exchange = dataclasses.replace(
+        venue.exchange,
+        url=str(server.make_url("/rest")),
+        ws_url=str(server.make_url("/stream")).replace("http", "ws", 1),
+        interval=args.interval
+    )
+    name: str = exchange.name
+
+    # Keeps the backoff steps short: ~1-2s, then 2-4s from there on
+    app.config["exchange_max_backoff"] = args.max_backoff
+
+    publishes: list[float] = []
+
+    async def publish_kas_rates():
+        publishes.append(time.monotonic())
+
+    app.publish_kas_rates = publish_kas_rates
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+        tasks: list[asyncio.Task] = [
+            asyncio.create_task(app.stream_exchange(exchange, session)),
+            asyncio.create_task(app.poll_exchange(exchange, session)),
+            asyncio.create_task(app.publish_kas_rates_loop())
+        ]
+
+        try:
+            # Subscribe and parse
+            await wait_for(lambda: name in app.streams_seen, 5, "stream delivered no price")
+            subscriptions: list = [without_time(message) for message in venue.subscriptions]
+            check(
+                subscriptions == [without_time(exchange.ws_subscribe)],
+                "subscribe",
+                f"{venue.subscriptions}"
+            )
+
+            streaming_at: float = time.monotonic()
+            sent_before: int = venue.sent
+            publishes_before: int = len(publishes)
+            await asyncio.sleep(args.burst)
+
+            check(
+                abs(app.kas_rates[name][0] - venue.price) < 0.0001,
+                "streamed price parsed",
+                f"{app.kas_rates[name][0]:.8f} vs {venue.price:.8f}"
+            )
+            check(
+                not any(at > streaming_at + SLACK for at in venue.rest_requests),
+                "REST idle while streaming",
+                f"{len(venue.rest_requests)} requests in total"
+            )
+
+            # The first publish after the stream came up can still be waiting on the rate limit
+            burst_publishes: int = len(publishes) - publishes_before
+            allowed: int = int(args.burst * app.config["kas_rates_max_publish_rate"]) + 1
+            check(
+                0 < burst_publishes <= allowed,
+                "publishes coalesced",
+                f"{venue.sent - sent_before} price changes, {burst_publishes} publishes (max {allowed})"
+            )
+
+            # Drop the stream and refuse the reconnects
+            venue.accepting = False
+            connects_before: int = len(venue.connects)
+            dropped_at: float = time.monotonic()
+            venue.dropped.set()
+
+            await wait_for(
+                lambda: len(venue.connects) >= connects_before + args.failures,
+                args.failures * (args.max_backoff + SLACK) + 2 + SLACK,
+                "stream was not reconnected"
+            )
+            check(name not in app.streams_seen, "streams_seen cleared", f"{sorted(app.streams_seen)}")
+
+            attempts: list[float] = [dropped_at] + venue.connects[connects_before:]
+            # The drop fails once (the price reset the count), each refused handshake once more
+            delays: list[tuple[float, float]] = [
+                (min(args.max_backoff, 2 ** failures) / 2, min(args.max_backoff, 2 ** failures))
+                for failures in range(1, args.failures + 1)
+            ]
+            gaps: list[float] = [later - earlier for earlier, later in zip(attempts, attempts[1:])]
+            check(
+                all(low - SLACK <= gap <= high + SLACK for gap, (low, high) in zip(gaps, delays)),
+                "reconnect backoff",
+                ", ".join(f"{gap:.2f}s in {low:.0f}-{high:.0f}s" for gap, (low, high) in zip(gaps, delays))
+            )
+
+            rest_during_drop: int = sum(1 for at in venue.rest_requests if at > dropped_at)
+            check(rest_during_drop > 0, "REST took over", f"{rest_during_drop} requests while down")
+
+            # Recover
+            venue.accepting = True
+            venue.dropped.clear()
+
+            await wait_for(
+                lambda: name in app.streams_seen,
+                args.max_backoff + 2 + SLACK,
+                "stream did not recover"
+            )
+            check(len(venue.subscriptions) == 2, "resubscribed", f"{len(venue.subscriptions)} subscriptions")
+
+            recovered_at: float = time.monotonic()
+            await asyncio.sleep(args.interval * 4)
+
+            # A request already in flight at the switch may still land
+            rest_after: int = sum(1 for at in venue.rest_requests if at > recovered_at)
+            check(rest_after <= 1, "REST idle again", f"{rest_after} requests after recovery")
+        finally:
+            venue.dropped.set()
+
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    await server.close()
+
+
+def main():
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--exchange", default="bybit")
+    parser.add_argument("--interval", type=float, default=0.2)
+    parser.add_argument("--burst", type=float, default=3)
+    parser.add_argument("--failures", type=int, default=3)
+    parser.add_argument("--max-backoff", type=float, default=4)
+    args: argparse.Namespace = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
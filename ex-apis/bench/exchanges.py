@@ -0,0 +1,96 @@
+"""
+Parses one recorded response per registered exchange and reports the cost per quote:
+
+    python bench/exchanges.py --iterations 100000
+
+Every exchange in the registry must have a REST fixture (and a stream fixture if it
+declares ws_url), so a new venue cannot be added without being covered here. A
+declared volume_path must resolve in the REST fixture.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from main import exchanges, parse_price, parse_volume  # noqa: E402
+
+REST_FIXTURES: dict[str, object] = {
+    "bybit": {"retCode": 0, "result": {"list": [{"symbol": "KASUSDT", "lastPrice": "0.11812", "volume24h": "51234567.8"}]}},
+    "kraken": {"error": [], "result": {"KASUSD": {"c": ["0.118130", "1520.0"], "v": ["812345.1", "4123456.7"]}}},
+    "kucoin": {"code": "200000", "data": {"price": "0.11814"}},
+    "mexc": {"symbol": "KASUSDT", "price": "0.11815"},
+    "coinex": {"code": 0, "data": {"ticker": {"last": "0.11816", "vol": "2345678.9"}}},
+    "gate": {"result": "true", "last": "0.11817", "baseVolume": "9876543.2"},
+    "digifinex": {"code": 0, "ticker": [{"last": 0.11818, "vol": 1234567.8}]},
+    "xeggex": {"lastPrice": "0.11819"},
+    "uphold": {"ask": "0.11820", "bid": "0.11790"},
+    "bitget": {"code": "00000", "data": [{"lastPr": "0.11821", "baseVolume": "7654321.0"}]},
+    "lbank": {"result": "true", "data": [{"ticker": {"latest": 0.11822, "vol": 345678.9}}]},
+    "bydfi": {"code": 200, "asks": [{"price": "0.11823"}]},
+    "btse": [{"lastPrice": 0.11824}]
+}
+
+STREAM_FIXTURES: dict[str, dict] = {
+    "bybit": {"topic": "tickers.KASUSDT", "data": {"lastPrice": "0.11812"}},
+    "kraken": {"channel": "ticker", "type": "update", "data": [{"symbol": "KAS/USD", "last": 0.11813}]},
+    "gate": {"channel": "spot.tickers", "event": "update", "result": {"last": "0.11817"}},
+    "bitget": {"action": "snapshot", "arg": {"channel": "ticker"}, "data": [{"lastPr": "0.11821"}]}
+}
+
+
+def bench(name: str, data, conditions: tuple, price_path: tuple, iterations: int) -> tuple[float, float]:
+    price: float | None = parse_price(data, conditions, price_path)
+    if price is None:
+        raise SystemExit(f"{name}: fixture does not match the registry")
+
+    started_at: float = time.perf_counter()
+    for _ in range(iterations):
+        parse_price(data, conditions, price_path)
+    elapsed: float = time.perf_counter() - started_at
+
+    return price, elapsed / iterations * 1e9
+
+
+def main():
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100_000)
+    args: argparse.Namespace = parser.parse_args()
+
+    print(f"{'exchange':<20}{'price':>12}{'ns/quote':>12}")
+
+    for exchange in exchanges:
+        if exchange.name not in REST_FIXTURES:
+            raise SystemExit(f"{exchange.name}: no REST fixture")
+
+        price, cost = bench(
+            exchange.name,
+            REST_FIXTURES[exchange.name],
+            exchange.success,
+            exchange.price_path,
+            args.iterations
+        )
+        print(f"{exchange.name:<20}{price:>12.5f}{cost:>12.0f}")
+
+        if exchange.volume_path and parse_volume(REST_FIXTURES[exchange.name], exchange.volume_path) is None:
+            raise SystemExit(f"{exchange.name}: volume_path does not match the fixture")
+
+        if exchange.ws_url is None:
+            continue
+
+        if exchange.name not in STREAM_FIXTURES:
+            raise SystemExit(f"{exchange.name}: no stream fixture")
+
+        price, cost = bench(
+            exchange.name,
+            STREAM_FIXTURES[exchange.name],
+            exchange.ws_match,
+            exchange.ws_price_path,
+            args.iterations
+        )
+        print(f"{exchange.name + ' (stream)':<20}{price:>12.5f}{cost:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,38 @@
+import os
+import re
 import logging
+import logging.handlers
+import queue
+import atexit
 import json
+import hashlib
+import math
+import time
 
 import asyncio
 from asyncio.tasks import Task
 
-from typing import Sequence
-from datetime import datetime
+from datetime import datetime, timezone
 from contextlib import asynccontextmanager
+from collections.abc import AsyncIterator
+
+from alembic import command
+from alembic.config import Config as AlembicConfig
 
 from sqlalchemy import (
+    BigInteger,
+    Connection,
     DateTime,
     String,
     Float,
     Integer,
     ForeignKey,
-    select
+    Index,
+    UniqueConstraint,
+    Select,
+    select,
+    func,
+    text
 )
 from sqlalchemy.orm import (
     DeclarativeBase,
@@ -30,9 +48,21 @@ from sqlalchemy.ext.asyncio import (
     AsyncAttrs
 )
 
-from redis.asyncio.client import Redis, PubSub
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+    multiprocess
+)
+
+from redis.asyncio.client import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Response, Query, HTTPException
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -41,6 +71,12 @@ class Base(AsyncAttrs, DeclarativeBase):
 
 class KRC20Transaction(Base):
     __tablename__ = "krc20_transactions"
+    __table_args__ = (
+        Index("ix_krc20_transactions_created_at", "created_at"),
+        Index("ix_krc20_transactions_id_source_created_at", "id_source", "created_at"),
+        Index("ix_krc20_transactions_ticker_created_at", "ticker", "created_at"),
+        UniqueConstraint("id_source", "external_id", name="uq_krc20_transactions_id_source_external_id")
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     id_source: Mapped[int] = mapped_column(Integer, ForeignKey("sources.id"), nullable=False)
@@ -51,6 +87,12 @@ class KRC20Transaction(Base):
         DateTime(timezone=True),
         nullable=False
     )
+    # Message id in the source (Telegram message id for the KSPR bot)
+    external_id: Mapped[int | None] = mapped_column(BigInteger)
+    # Posted by the KSPR bot along with the amounts, not by every source
+    price: Mapped[float | None] = mapped_column(Float)
+    buyer: Mapped[str | None] = mapped_column(String(128))
+    tx_hash: Mapped[str | None] = mapped_column(String(128))
 
     source: Mapped["Source"] = relationship(back_populates="krc20_transactions")
 
@@ -61,36 +103,164 @@ class Source(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String(30), nullable=False)
     link: Mapped[str | None] = mapped_column(String)
+    # Newest external_id written from this source, where the next sync resumes
+    last_external_id: Mapped[int | None] = mapped_column(BigInteger)
 
     krc20_transactions: Mapped[list["KRC20Transaction"]] = relationship(back_populates="source")
 
 
+class KRC20Candle(Base):
+    __tablename__ = "krc20_candles"
+
+    ticker: Mapped[str] = mapped_column(String(6), primary_key=True)
+    interval: Mapped[str] = mapped_column(String(3), primary_key=True)
+    bucket: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    open: Mapped[float] = mapped_column(Float, nullable=False)
+    high: Mapped[float] = mapped_column(Float, nullable=False)
+    low: Mapped[float] = mapped_column(Float, nullable=False)
+    close: Mapped[float] = mapped_column(Float, nullable=False)
+    volume_krc20: Mapped[float] = mapped_column(Float, nullable=False)
+    volume_kas: Mapped[float] = mapped_column(Float, nullable=False)
+    trades: Mapped[int] = mapped_column(Integer, nullable=False)
+    open_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    close_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+
+        if getattr(record, "repeated", 0):
+            entry["repeated"] = record.repeated
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RepeatSampler(logging.Filter):
+    """Passes a repeated warning or error once per window, with the count of dropped repeats."""
+
+    def __init__(self, window: float, max_keys: int = 10000):
+        super().__init__()
+        self.window: float = window
+        self.max_keys: int = max_keys
+        # Sampling key (see get_key) -> [time.monotonic() of the last pass, dropped since]
+        self.seen: dict[tuple, list] = {}
+
+    @staticmethod
+    def get_key(record: logging.LogRecord) -> tuple:
+        # The call site rather than the message, which usually embeds per-attempt
+        # detail (ids, URLs, exception reprs) and would never repeat. A log call
+        # shared by several subjects passes extra={"sample_key": ...} to keep them apart.
+        return (
+            record.name,
+            record.levelno,
+            record.pathname,
+            record.lineno,
+            record.exc_info[0] if record.exc_info else None,
+            getattr(record, "sample_key", None)
+        )
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+
+        key: tuple = self.get_key(record)
+        now: float = time.monotonic()
+        seen: list | None = self.seen.get(key)
+
+        if seen is not None and now - seen[0] < self.window:
+            seen[1] += 1
+            return False
+
+        if seen is not None:
+            record.repeated = seen[1]
+        elif len(self.seen) >= self.max_keys:
+            self.seen.clear()
+
+        self.seen[key] = [now, 0]
+        return True
+
+
 config: dict = {
     "last_krc20_transactions_count": 100,
-    "last_krc20_transactions_kspr_count": 100
+    "last_krc20_transactions_source_count": 100,
+    "last_krc20_transactions_key": "krc20:last_transactions",
+    "last_krc20_transactions_source_key": "krc20:last_transactions:source:{}",
+    "redis_rebuild_chunk_size": 1000,
+    # Bump when the layout of the cached keys changes, the next start rebuilds them
+    "redis_cache_version": 3,
+    "krc20_trades_key": "krc20:trades:{}",
+    "krc20_trades_per_ticker": 1000,
+    "krc20_candle_intervals": {
+        "1m": 60,
+        "5m": 5 * 60,
+        "1h": 60 * 60,
+        "1d": 24 * 60 * 60
+    },
+    "migrations_lock_key": 2193761946,
+    "warm_up_lock_key": 2193761947,
+    "ws_frame_version": 1,
+    "kas_rates_history_default_range": 60 * 60 * 1000,
+    "kas_rates_history_max_points": 1000,
+    "krc20_candles_max_limit": 1000,
+    "krc20_trades_max_limit": 1000,
+    "ws_client_queue_size": 256,
+    "ws_client_max_topics": 50,
+    "ws_default_topics": ["*"],
+    "ws_client_send_timeout": 10,
+    "ws_hub_reconnect_delay": 1,
+    "updates_stream_key": "updates",
+    # Milliseconds one XREAD waits for new entries, and entries taken per read
+    "updates_read_block": 5000,
+    "updates_read_count": 500,
+    "ws_replay_max_events": 1000,
+    "log_max_bytes": 10 * 1024 * 1024,
+    "log_backup_count": 5,
+    "log_sample_window": 60
 }
 
-logging.basicConfig(
-    filename="app.log",
-    format="[%(levelname)s] %(asctime)s: %(name)s %(message)s",
-    level=logging.WARNING
+# Every worker rotates its own file, several processes can't safely share one
+log_file: str = f"app.{os.getpid()}.log" if os.getenv("LOG_FILE_PER_PROCESS") else "app.log"
+
+# Handlers do their I/O on the listener thread, the event loop only puts records on a queue
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+queue_handler: logging.handlers.QueueHandler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(RepeatSampler(config["log_sample_window"]))
+# QueueHandler merges the traceback into the message before enqueueing, so the
+# JSON formatter never sees exc_info; "%(message)s" keeps basicConfig from adding its own format
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+file_handler: logging.handlers.RotatingFileHandler = logging.handlers.RotatingFileHandler(
+    log_file,
+    maxBytes=config["log_max_bytes"],
+    backupCount=config["log_backup_count"],
+    encoding="utf-8"
 )
-
-app_logger: logging.Logger = logging.getLogger("app_logger")
-file_handler: logging.FileHandler = logging.FileHandler("app.log")
 console_handler: logging.StreamHandler = logging.StreamHandler()
-formatter: logging.Formatter = logging.Formatter("[%(levelname)s] %(asctime)s: %(name)s %(message)s")
 
-app_logger.setLevel(logging.DEBUG)
 file_handler.setLevel(logging.INFO)
 console_handler.setLevel(logging.DEBUG)
 
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+file_handler.setFormatter(JSONFormatter())
+console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s: %(name)s %(message)s"))
 
-app_logger.addHandler(file_handler)
-app_logger.addHandler(console_handler)
+log_listener: logging.handlers.QueueListener = logging.handlers.QueueListener(
+    log_queue, file_handler, console_handler, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Library loggers (SQLAlchemy, Alembic, redis) go through the same queue
+logging.basicConfig(level=logging.WARNING, handlers=[queue_handler])
 
+app_logger: logging.Logger = logging.getLogger("app_logger")
+app_logger.setLevel(logging.DEBUG)
+app_logger.addHandler(queue_handler)
 app_logger.propagate = False
 
 engine: AsyncEngine = create_async_engine(
@@ -100,23 +270,313 @@ async_session: async_sessionmaker = async_sessionmaker(engine, expire_on_commit=
 
 redis_client: Redis = Redis(host="redis-server", decode_responses=True)
 
+# Every worker writes its own samples to PROMETHEUS_MULTIPROC_DIR, /metrics merges them
+ws_connections: Gauge = Gauge(
+    "ws_connections", "Open websocket connections", multiprocess_mode="livesum"
+)
+ws_send_queue_depth: Gauge = Gauge(
+    "ws_send_queue_depth", "Frames waiting in websocket send queues, summed at the last broadcast",
+    multiprocess_mode="livesum"
+)
+ws_send_queue_depth_max: Gauge = Gauge(
+    "ws_send_queue_depth_max", "Deepest websocket send queue at the last broadcast",
+    multiprocess_mode="livemax"
+)
+ws_broadcast_seconds: Histogram = Histogram(
+    "ws_broadcast_seconds", "Time to fan a frame out to the send queues of a worker",
+    buckets=(.00001, .00005, .0001, .0005, .001, .005, .01, .05)
+)
+ws_send_seconds: Histogram = Histogram(
+    "ws_send_seconds", "Time to write one frame to a websocket",
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1)
+)
+ws_slow_disconnects: Counter = Counter(
+    "ws_slow_disconnects", "Websockets dropped for not keeping up"
+)
+
+
+class WSClient:
+    def __init__(self, websocket: WebSocket):
+        self.websocket: WebSocket = websocket
+        # (event id, frame); frames the client asked for directly carry no id
+        self.queue: asyncio.Queue[tuple[tuple[int, int] | None, str]] = asyncio.Queue(
+            maxsize=config["ws_client_queue_size"]
+        )
+        self.sender: Task | None = None
+        self.topics: set[str] = set()
+        # Events up to this id were already sent by the replay on connect
+        self.replayed_until: tuple[int, int] | None = None
+
+    def start(self):
+        self.sender = asyncio.create_task(self.send_loop())
+
+    def stop(self):
+        # A sender disconnecting its own client is left to return by itself, cancelling
+        # it here would abort the disconnect before the socket is closed
+        if self.sender is not None and self.sender is not asyncio.current_task():
+            self.sender.cancel()
+
+    async def send_loop(self):
+        while True:
+            event_id, data = await self.queue.get()
+            if event_id is not None and self.replayed_until is not None and event_id <= self.replayed_until:
+                continue
+
+            try:
+                with ws_send_seconds.time():
+                    await asyncio.wait_for(
+                        self.websocket.send_text(data),
+                        timeout=config["ws_client_send_timeout"]
+                    )
+            except Exception as exc:
+                app_logger.info(f"WS client send failed, disconnecting: {exc!r}")
+                await ws_hub.disconnect(self)
+                return
+
+
+class Snapshot:
+    """Latest transactions and rates, rebuilt only after Redis publishes a change."""
+
+    def __init__(self):
+        self.dirty: bool = True
+        self.lock: asyncio.Lock = asyncio.Lock()
+        # (id, ticker, transaction JSON), in the order they were published
+        self.transactions: list[tuple[int, str, str]] = []
+        # Transaction id -> index in transactions
+        self.positions: dict[int, int] = {}
+        self.kas_rates: str | None = None
+        self.kas_aggregate: str | None = None
+        self.frame: str = ""
+        self.etag: str = ""
+
+    def invalidate(self):
+        self.dirty = True
+
+    async def refresh(self):
+        if not self.dirty:
+            return
+
+        async with self.lock:
+            if not self.dirty:
+                return
+
+            # Cleared before reading so a change published meanwhile triggers another rebuild
+            self.dirty = False
+
+            transactions: list[str] = await get_list_redis(config["last_krc20_transactions_key"])
+            self.kas_rates, self.kas_aggregate = await redis_client.mget("kas-rates", "kas-aggregate")
+            self.transactions = []
+            for transaction in reversed(transactions):
+                transaction_data: dict = json.loads(transaction)
+                self.transactions.append(
+                    (transaction_data.get("id", 0), transaction_data["ticker"], transaction)
+                )
+            self.positions = {
+                transaction_id: index for index, (transaction_id, _, _) in enumerate(self.transactions)
+            }
+
+            self.frame = self.build(self.transactions, True)
+            self.etag = '"' + hashlib.sha1(self.frame.encode()).hexdigest() + '"'
+
+    def build(
+            self,
+            transactions: list[tuple[int, str, str]],
+            full: bool,
+            topics: set[str] | None = None
+    ) -> str:
+        kas_rates: str | None = self.kas_rates
+        kas_aggregate: str | None = self.kas_aggregate
+
+        if topics is not None:
+            transactions = [
+                transaction for transaction in transactions
+                if topic_matches(topics, f"krc20:{transaction[1]}")
+            ]
+            kas_rates = kas_rates if topic_matches(topics, "rates") else None
+            kas_aggregate = kas_aggregate if topic_matches(topics, "aggregate") else None
+
+        return build_frame(
+            "snapshot",
+            '{"full":' + ("true" if full else "false")
+            + ',"transactions":[' + ",".join(transaction for _, _, transaction in transactions) + "]"
+            + ',"kas_rates":' + (kas_rates or "null")
+            + ',"kas_aggregate":' + (kas_aggregate or "null") + "}"
+        )
+
+    async def get_frame(self, since: int | None = None, topics: set[str] | None = None) -> str:
+        await self.refresh()
+
+        if topics is not None and "*" in topics:
+            topics = None
+
+        # since names the last transaction the client has, not an id threshold: ids are
+        # not published in increasing order (a sync inserts rows after ids were reserved
+        # for live trades), so the delta is what was published after that transaction.
+        # It is only usable while that transaction is still inside the cached window.
+        index: int | None = self.positions.get(since) if since is not None else None
+        if index is None:
+            return self.frame if topics is None else self.build(self.transactions, True, topics)
+
+        return self.build(self.transactions[index + 1:], False, topics)
+
+
+class WSHub:
+    """One reader of the updates stream per worker, fanned out to every local websocket."""
+
+    def __init__(self):
+        self.clients: set[WSClient] = set()
+        # Topic or pattern ("krc20:*", "*") -> subscribed clients
+        self.topics: dict[str, set[WSClient]] = {}
+        self.reader: Task | None = None
+        # Pending disconnects, referenced so they are not garbage collected midway
+        self.disconnects: set[Task] = set()
+
+    def start(self):
+        self.reader = asyncio.create_task(self.read_loop())
+
+    async def stop(self):
+        if self.reader is not None:
+            self.reader.cancel()
+
+        for client in list(self.clients):
+            client.stop()
+        self.clients.clear()
+        self.topics.clear()
+
+    def register(self, client: WSClient, topics: set[str]):
+        self.clients.add(client)
+        self.subscribe(client, topics)
+        ws_connections.inc()
+
+    def unregister(self, client: WSClient):
+        if client in self.clients:
+            self.clients.discard(client)
+            ws_connections.dec()
+
+        self.unsubscribe(client, set(client.topics))
+        client.stop()
+
+    def subscribe(self, client: WSClient, topics: set[str]):
+        for topic in topics:
+            if len(client.topics) >= config["ws_client_max_topics"]:
+                break
+
+            client.topics.add(topic)
+            self.topics.setdefault(topic, set()).add(client)
+
+    def unsubscribe(self, client: WSClient, topics: set[str]):
+        for topic in topics:
+            client.topics.discard(topic)
+
+            subscribers: set[WSClient] | None = self.topics.get(topic)
+            if subscribers is None:
+                continue
+
+            subscribers.discard(client)
+            if not subscribers:
+                del self.topics[topic]
+
+    async def disconnect(self, client: WSClient):
+        if client not in self.clients:
+            return
+
+        self.unregister(client)
+
+        try:
+            await client.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    def broadcast(self, topic: str, event_id: tuple[int, int], data: str):
+        started_at: float = time.perf_counter()
+        queued: int = 0
+        queued_max: int = 0
+
+        # Exact topic plus every pattern that can match it: "*", "krc20:*", ...
+        recipients: set[WSClient] = set()
+        for key in get_topic_keys(topic):
+            subscribers: set[WSClient] | None = self.topics.get(key)
+            if subscribers:
+                recipients |= subscribers
+
+        # Publishers send ready-made frames, the same string goes to every client
+        for client in recipients:
+            try:
+                client.queue.put_nowait((event_id, data))
+            except asyncio.QueueFull:
+                ws_slow_disconnects.inc()
+                app_logger.warning("WS client is too slow, disconnecting")
+                task: Task = asyncio.create_task(self.disconnect(client))
+                self.disconnects.add(task)
+                task.add_done_callback(self.disconnects.discard)
+                continue
+
+            depth: int = client.queue.qsize()
+            queued += depth
+            queued_max = max(queued_max, depth)
+
+        ws_send_queue_depth.set(queued)
+        ws_send_queue_depth_max.set(queued_max)
+        ws_broadcast_seconds.observe(time.perf_counter() - started_at)
+
+    async def read_loop(self):
+        # Plain XREAD rather than a consumer group: a group would split the entries
+        # between the workers, and every worker needs all of them for its own clients.
+        # The position survives reconnects, so entries added meanwhile are not skipped.
+        last_id: str | None = None
+
+        while True:
+            try:
+                if last_id is None:
+                    last_id = await get_last_event_id()
+
+                while True:
+                    streams: list = await redis_client.xread(
+                        {config["updates_stream_key"]: last_id},
+                        count=config["updates_read_count"],
+                        block=config["updates_read_block"]
+                    )
+                    if not streams:
+                        continue
+
+                    snapshot.invalidate()
+
+                    for event_id, fields in streams[0][1]:
+                        last_id = event_id
+
+                        try:
+                            self.broadcast(
+                                fields["topic"],
+                                parse_event_id(event_id),
+                                add_event_id(fields["frame"], event_id)
+                            )
+                        except Exception as exc:
+                            # A malformed entry is skipped, not retried
+                            app_logger.error(f"WS hub skipped stream entry {event_id}: {exc!r}")
+            except RedisConnectionError as exc:
+                app_logger.error(f"WS hub lost Redis connection: {exc}")
+            except Exception as exc:
+                # The reader must outlive any error, every websocket of this worker depends on it
+                app_logger.error(f"WS hub read error: {exc!r}")
+
+            snapshot.invalidate()
+            await asyncio.sleep(config["ws_hub_reconnect_delay"])
+
+
+snapshot: Snapshot = Snapshot()
+ws_hub: WSHub = WSHub()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Workers keep no state of their own beyond caches derived from Redis,
+    # so any number of them (on any number of nodes) can run side by side.
     await init_db()
+    await warm_up_redis()
 
-    last_krc20_transactions, last_krc20_transactions_kspr = await get_last_krc20_transactions()
-
-    last_krc20_transactions_redis: list[str] = await krc20_transactions_to_redis(
-        last_krc20_transactions
-    )
-    last_krc20_transactions_kspr_redis: list[str] = await krc20_transactions_to_redis(
-        last_krc20_transactions_kspr
-    )
-
-    await init_redis(last_krc20_transactions_redis, last_krc20_transactions_kspr_redis)
-    await mark_as_done_in_redis()
+    ws_hub.start()
     yield
+    await ws_hub.stop()
 
 
 app: FastAPI = FastAPI(
@@ -128,60 +588,162 @@ app: FastAPI = FastAPI(
 
 
 async def mark_as_done_in_redis():
-    await redis_client.set("fastapi-core-ready", 1)
-
+    await redis_client.set("fastapi-core-ready", config["redis_cache_version"])
+
+
+def krc20_transaction_to_redis(row) -> str:
+    # Same fields in the same order as telethon-kspr publishes them, so a trade
+    # is the same sorted set member whether it was published or rebuilt
+    return json.dumps({
+        "id": row.id,
+        "id_source": row.id_source,
+        "ticker": row.ticker,
+        "krc20_amount": row.krc20_amount,
+        "kas_amount": row.kas_amount,
+        "price": row.price,
+        "buyer": row.buyer,
+        "tx_hash": row.tx_hash,
+        "created_at": int(row.created_at.timestamp() * 1000)
+    }, separators=(",", ":"))
+
+
+def get_last_krc20_transactions_query(limit: int, *where) -> Select:
+    # Only the columns that go to Redis, no ORM entities
+    return select(
+        KRC20Transaction.id,
+        KRC20Transaction.id_source,
+        KRC20Transaction.ticker,
+        KRC20Transaction.krc20_amount,
+        KRC20Transaction.kas_amount,
+        KRC20Transaction.price,
+        KRC20Transaction.buyer,
+        KRC20Transaction.tx_hash,
+        KRC20Transaction.created_at
+    ).where(
+        *where
+    ).order_by(
+        KRC20Transaction.created_at.desc()
+    ).limit(
+        limit
+    )
 
-async def get_last_krc20_transactions() -> tuple[Sequence[KRC20Transaction], Sequence[KRC20Transaction]]:
-    async with async_session() as session:
-        last_krc20_transactions: Sequence[KRC20Transaction] = (await session.execute(
-            select(KRC20Transaction).order_by(
-                KRC20Transaction.created_at.desc()
-            ).limit(
-                config["last_krc20_transactions_count"]
-            )
-        )).scalars().all()
-
-        last_krc20_transactions_kspr: Sequence[KRC20Transaction] = (await session.execute(
-            select(KRC20Transaction).where(
-                KRC20Transaction.id_source == 1
-            ).order_by(
-                KRC20Transaction.created_at.desc()
-            ).limit(
-                config["last_krc20_transactions_kspr_count"]
-            )
-        )).scalars().all()
 
-    return last_krc20_transactions, last_krc20_transactions_kspr
+async def rebuild_list_redis(conn: AsyncConnection, key: str, query: Select):
+    # Rows stream from Postgres into a temporary key which then replaces the
+    # live one in a single RENAME, so readers never see a missing or half-built list.
+    temp_key: str = f"{key}:rebuild"
+    count: int = 0
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.delete(temp_key)
+
+        async for partition in (await conn.stream(
+            query.execution_options(yield_per=config["redis_rebuild_chunk_size"])
+        )).partitions():
+            pipe.rpush(temp_key, *[krc20_transaction_to_redis(row) for row in partition])
+            count += len(partition)
+
+            await pipe.execute()
+
+        if count != 0:
+            pipe.rename(temp_key, key)
+        else:
+            pipe.delete(key)
+
+        await pipe.execute()
+
+
+async def rebuild_trades_redis(conn: AsyncConnection):
+    # The newest krc20_trades_per_ticker trades of every ticker, each ticker's sorted
+    # set built aside and swapped in with RENAME like the lists
+    ranked = select(
+        KRC20Transaction.id,
+        KRC20Transaction.id_source,
+        KRC20Transaction.ticker,
+        KRC20Transaction.krc20_amount,
+        KRC20Transaction.kas_amount,
+        KRC20Transaction.price,
+        KRC20Transaction.buyer,
+        KRC20Transaction.tx_hash,
+        KRC20Transaction.created_at,
+        func.row_number().over(
+            partition_by=KRC20Transaction.ticker,
+            order_by=KRC20Transaction.created_at.desc()
+        ).label("rank")
+    ).subquery()
+    query: Select = select(ranked).where(ranked.c.rank <= config["krc20_trades_per_ticker"])
+
+    tickers: set[str] = set()
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        async for partition in (await conn.stream(
+            query.execution_options(yield_per=config["redis_rebuild_chunk_size"])
+        )).partitions():
+            for row in partition:
+                temp_key: str = config["krc20_trades_key"].format(row.ticker) + ":rebuild"
+
+                if row.ticker not in tickers:
+                    tickers.add(row.ticker)
+                    pipe.delete(temp_key)
+
+                pipe.zadd(temp_key, {krc20_transaction_to_redis(row): int(row.created_at.timestamp() * 1000)})
+
+            await pipe.execute()
+
+        for ticker in tickers:
+            key: str = config["krc20_trades_key"].format(ticker)
+            pipe.rename(f"{key}:rebuild", key)
+
+        await pipe.execute()
+
+
+async def init_redis(conn: AsyncConnection):
+    # Only the krc20:* lists are rebuilt; kas-rates and its history belong to ex-apis
+    await redis_client.delete(
+        "last_krc20_transactions",
+        "last_krc20_transactions_kspr",
+        "krc20:last_transactions:kspr"
+    )
 
+    await rebuild_list_redis(
+        conn,
+        config["last_krc20_transactions_key"],
+        get_last_krc20_transactions_query(config["last_krc20_transactions_count"])
+    )
 
-async def krc20_transactions_to_redis(transactions: Sequence[KRC20Transaction]) -> list[str]:
-    transactions_redis: list[str] = []
+    # One list per source, telethon-kspr keeps them up to date from then on
+    for id_source in (await conn.execute(select(Source.id))).scalars().all():
+        await rebuild_list_redis(
+            conn,
+            config["last_krc20_transactions_source_key"].format(id_source),
+            get_last_krc20_transactions_query(
+                config["last_krc20_transactions_source_count"],
+                KRC20Transaction.id_source == id_source
+            )
+        )
 
-    for transaction in transactions:
-        transaction_redis: str = json.dumps({
-            "id_source": transaction.id_source,
-            "ticker": transaction.ticker,
-            "krc20_amount": transaction.krc20_amount,
-            "kas_amount": transaction.kas_amount,
-            "created_at": int(transaction.created_at.timestamp() * 1000)
-        })
+    await rebuild_trades_redis(conn)
 
-        transactions_redis.append(transaction_redis)
 
-    return transactions_redis
+def run_migrations(conn: Connection):
+    alembic_config: AlembicConfig = AlembicConfig("alembic.ini")
+    alembic_config.attributes["connection"] = conn
+    alembic_config.attributes["target_metadata"] = Base.metadata
 
+    command.upgrade(alembic_config, "head")
 
-async def init_redis(
-        last_krc20_transactions: list[str],
-        last_krc20_transactions_kspr: list[str]
-):
-    await redis_client.flushall()
 
-    if len(last_krc20_transactions) != 0:
-        await redis_client.rpush("last_krc20_transactions", *last_krc20_transactions)
+@asynccontextmanager
+async def advisory_lock(conn: AsyncConnection, key: int) -> AsyncIterator[None]:
+    # Session-level Postgres lock: shared by every worker and replica that uses the same DB
+    await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
 
-    if len(last_krc20_transactions_kspr) != 0:
-        await redis_client.rpush("last_krc20_transactions_kspr", *last_krc20_transactions_kspr)
+    try:
+        yield
+    finally:
+        await conn.rollback()
+        await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+        await conn.commit()
 
 
 async def init_db():
@@ -189,9 +751,11 @@ async def init_db():
 
     app_logger.info("Init DB")
 
-    async with engine.begin() as conn:
-        # await conn.run_sync(Base.metadata.drop_all)
-        await conn.run_sync(Base.metadata.create_all)
+    async with engine.connect() as conn:
+        # Every worker runs lifespan, only one of them may migrate at a time
+        async with advisory_lock(conn, config["migrations_lock_key"]):
+            await conn.run_sync(run_migrations)
+            await conn.commit()
 
     async with async_session() as session:
         source: Source | None = (await session.execute(
@@ -208,50 +772,327 @@ async def init_db():
             await session.commit()
 
 
-async def add_pupsub_reader(pubsub: PubSub, websocket: WebSocket):
-    while True:
-        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.2)
+async def warm_up_redis():
+    conn: AsyncConnection
+
+    async with engine.connect() as conn:
+        async with advisory_lock(conn, config["warm_up_lock_key"]):
+            # The first worker to get here fills the cache, the rest (and any replica
+            # started later) find it ready and must not overwrite what telethon-kspr
+            # has pushed since. A cache built for an older layout is rebuilt once.
+            if await redis_client.get("fastapi-core-ready") == str(config["redis_cache_version"]):
+                return
 
-        if message:
-            await websocket.send_text(message["data"])
+            app_logger.info("Warm up Redis")
+
+            await init_redis(conn)
+            await mark_as_done_in_redis()
 
 
 async def get_list_redis(key: str) -> list[str]:
     return await redis_client.lrange(key, 0, -1)
 
 
-async def init_ws_client(websocket: WebSocket):
-    for transaction in reversed(await get_list_redis("last_krc20_transactions")):
-        await websocket.send_text(
-            json.dumps({
-                "method": "last_krc20_transaction",
-                "data": transaction
-            })
-        )
+def build_frame(method: str, data: str) -> str:
+    # data is already JSON (as stored in Redis), so it is spliced in as is
+    # instead of being parsed and encoded again.
+    return f'{{"v":{config["ws_frame_version"]},"method":{json.dumps(method)},"data":{data}}}'
+
+
+topic_pattern: re.Pattern = re.compile(r"^(\*|[a-z0-9-]+(:[A-Za-z0-9]+)*(:\*)?)$")
+
 
-    kas_rates: str | None = await redis_client.get("kas-rates")
-    if kas_rates:
-        await websocket.send_text(
-            json.dumps({
-                "method": "kas-rates",
-                "data": kas_rates
-            })
+def parse_topics(topics: list) -> set[str]:
+    # A bare string would otherwise be taken one character at a time
+    if not isinstance(topics, list):
+        raise TypeError("topics must be a list")
+
+    return {
+        topic for topic in topics
+        if isinstance(topic, str) and len(topic) <= 40 and topic_pattern.match(topic)
+    }
+
+
+def get_topic_keys(topic: str) -> list[str]:
+    keys: list[str] = [topic, "*"]
+
+    for i, char in enumerate(topic):
+        if char == ":":
+            keys.append(topic[:i + 1] + "*")
+
+    return keys
+
+
+def topic_matches(topics: set[str], topic: str) -> bool:
+    return any(key in topics for key in get_topic_keys(topic))
+
+
+async def get_last_event_id() -> str:
+    entries: list = await redis_client.xrevrange(config["updates_stream_key"], count=1)
+    return entries[0][0] if entries else "0-0"
+
+
+def parse_event_id(event_id: str) -> tuple[int, int] | None:
+    milliseconds, _, sequence = event_id.partition("-")
+
+    try:
+        return int(milliseconds), int(sequence or 0)
+    except ValueError:
+        return None
+
+
+def add_event_id(frame: str, event_id: str) -> str:
+    # Frames are stored without an id; it is spliced in once per worker, not per client
+    return f'{{"id":"{event_id}",{frame[1:]}'
+
+
+async def replay_events(client: WSClient, last_event_id: str, topics: set[str]) -> bool:
+    after: tuple[int, int] | None = parse_event_id(last_event_id)
+    if after is None:
+        return False
+
+    # Only a gapless replay can stand in for the snapshot: the client's event must
+    # still be in the stream, and what follows it must fit in ws_replay_max_events.
+    first: list = await redis_client.xrange(config["updates_stream_key"], count=1)
+    if not first or parse_event_id(first[0][0]) > after:
+        return False
+
+    entries: list = await redis_client.xrange(
+        config["updates_stream_key"],
+        min=f"({after[0]}-{after[1]}",
+        count=config["ws_replay_max_events"] + 1
+    )
+    if len(entries) > config["ws_replay_max_events"]:
+        return False
+
+    for event_id, fields in entries:
+        # Malformed entries are skipped here as well as by the hub
+        if "frame" in fields and topic_matches(topics, fields.get("topic", "")):
+            await client.websocket.send_text(add_event_id(fields["frame"], event_id))
+
+    # The client may already be ahead of this worker's reader (it resumed from
+    # a replica further along), so nothing up to its own id is sent again either
+    client.replayed_until = max(after, parse_event_id(entries[-1][0])) if entries else after
+    return True
+
+
+async def init_ws_client(
+        client: WSClient,
+        since: int | None,
+        topics: set[str],
+        last_event_id: str | None = None
+):
+    # A reconnecting client gets what it missed instead of a new snapshot
+    if last_event_id is not None and await replay_events(client, last_event_id, topics):
+        return
+
+    await client.websocket.send_text(await snapshot.get_frame(since, topics))
+
+
+def handle_ws_message(client: WSClient, text: str):
+    try:
+        message: dict = json.loads(text)
+        topics: set[str] = parse_topics(message["topics"])
+
+        if message["op"] == "subscribe":
+            ws_hub.subscribe(client, topics)
+        elif message["op"] == "unsubscribe":
+            ws_hub.unsubscribe(client, topics)
+        else:
+            return
+    except (ValueError, KeyError, TypeError):
+        return
+
+    try:
+        client.queue.put_nowait((None, build_frame("subscriptions", json.dumps(sorted(client.topics)))))
+    except asyncio.QueueFull:
+        pass
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    registry: CollectorRegistry = REGISTRY
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/snapshot")
+async def get_snapshot(request: Request) -> Response:
+    await snapshot.refresh()
+
+    headers: dict = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == snapshot.etag:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=snapshot.frame, media_type="application/json", headers=headers)
+
+
+@app.get("/kas-rates/exchanges")
+async def get_kas_exchanges() -> Response:
+    exchanges: str | None = await redis_client.get("kas-exchanges")
+
+    return Response(
+        content=exchanges or "[]",
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=300"}
+    )
+
+
+async def get_history(
+        series_filter: str,
+        label: str,
+        from_ts: int | None,
+        to_ts: int | None,
+        points: int
+) -> dict:
+    if to_ts is None:
+        to_ts = int(time.time() * 1000)
+    if from_ts is None:
+        from_ts = to_ts - config["kas_rates_history_default_range"]
+
+    # Bucket size is picked so that every series returns at most `points` samples
+    bucket: int = max(1, math.ceil((to_ts - from_ts) / points))
+    series: list = await redis_client.ts().mrange(
+        from_ts,
+        to_ts,
+        filters=[series_filter],
+        aggregation_type="avg",
+        bucket_size_msec=bucket,
+        with_labels=True
+    )
+
+    data: list[list] = []
+    for item in series:
+        for labels, samples in item.values():
+            data.append([
+                labels[label],
+                [[int(timestamp), float(value)] for timestamp, value in samples]
+            ])
+
+    return {
+        "from": from_ts,
+        "to": to_ts,
+        "bucket": bucket,
+        "data": data
+    }
+
+
+@app.get("/kas-rates/history")
+async def get_kas_rates_history(
+        from_ts: int | None = Query(None, alias="from"),
+        to_ts: int | None = Query(None, alias="to"),
+        points: int = Query(300, ge=1, le=config["kas_rates_history_max_points"])
+) -> dict:
+    return await get_history("type=kas-rate", "exchange", from_ts, to_ts, points)
+
+
+@app.get("/kas-rates/aggregate/history")
+async def get_kas_aggregate_history(
+        from_ts: int | None = Query(None, alias="from"),
+        to_ts: int | None = Query(None, alias="to"),
+        points: int = Query(300, ge=1, le=config["kas_rates_history_max_points"])
+) -> dict:
+    return await get_history("type=kas-aggregate", "field", from_ts, to_ts, points)
+
+
+@app.get("/krc20/{ticker}/trades")
+async def get_krc20_trades(
+        ticker: str,
+        since: int | None = None,
+        limit: int = Query(100, ge=1, le=config["krc20_trades_max_limit"])
+) -> Response:
+    # Newest first from the ticker's sorted set (score = created_at, ms):
+    # O(log n + limit) in Redis, Postgres is not touched
+    key: str = config["krc20_trades_key"].format(ticker)
+
+    if since is None:
+        trades: list[str] = await redis_client.zrange(key, 0, limit - 1, desc=True)
+    else:
+        trades = await redis_client.zrange(
+            key, "+inf", f"({since}", desc=True, byscore=True, offset=0, num=limit
         )
 
+    return Response(
+        '{"ticker":' + json.dumps(ticker) + ',"data":[' + ",".join(trades) + "]}",
+        media_type="application/json"
+    )
+
+
+@app.get("/krc20/{ticker}/candles")
+async def get_krc20_candles(
+        ticker: str,
+        interval: str = "1h",
+        from_ts: int | None = Query(None, alias="from"),
+        to_ts: int | None = Query(None, alias="to"),
+        limit: int = Query(300, ge=1, le=config["krc20_candles_max_limit"])
+) -> dict:
+    if interval not in config["krc20_candle_intervals"]:
+        raise HTTPException(status_code=400, detail="Unknown interval")
+
+    # Served from the rollup table's primary key, never from krc20_transactions
+    query = select(
+        KRC20Candle.bucket,
+        KRC20Candle.open,
+        KRC20Candle.high,
+        KRC20Candle.low,
+        KRC20Candle.close,
+        KRC20Candle.volume_krc20,
+        KRC20Candle.volume_kas,
+        KRC20Candle.trades
+    ).where(
+        KRC20Candle.ticker == ticker,
+        KRC20Candle.interval == interval
+    )
+
+    if from_ts is not None:
+        query = query.where(KRC20Candle.bucket >= datetime.fromtimestamp(from_ts / 1000, timezone.utc))
+    if to_ts is not None:
+        query = query.where(KRC20Candle.bucket <= datetime.fromtimestamp(to_ts / 1000, timezone.utc))
+
+    async with async_session() as session:
+        rows = (await session.execute(
+            query.order_by(KRC20Candle.bucket.desc()).limit(limit)
+        )).all()
+
+    return {
+        "ticker": ticker,
+        "interval": interval,
+        "data": [
+            [int(row.bucket.timestamp() * 1000), *row[1:]]
+            for row in reversed(rows)
+        ]
+    }
+
 
 @app.websocket("/ws")
-async def ws(websocket: WebSocket):
+async def ws(
+        websocket: WebSocket,
+        since: int | None = None,
+        topics: str | None = None,
+        last_event_id: str | None = None
+):
     await websocket.accept()
 
-    await init_ws_client(websocket)
+    client: WSClient = WSClient(websocket)
+    initial_topics: set[str] = parse_topics(
+        topics.split(",") if topics is not None else config["ws_default_topics"]
+    )
 
-    pubsub: PubSub = redis_client.pubsub()
-    await pubsub.subscribe("updates")
-    pubsub_reader: Task = asyncio.create_task(add_pupsub_reader(pubsub, websocket))
+    # Register before the initial sends so that nothing published meanwhile
+    # is lost; it waits in the client queue until the sender starts.
+    ws_hub.register(client, initial_topics)
 
     try:
+        await init_ws_client(client, since, initial_topics, last_event_id)
+        client.start()
+
         while True:
-            await websocket.receive_text()
+            handle_ws_message(client, await websocket.receive_text())
     except WebSocketDisconnect:
-        await pubsub.unsubscribe()
-        pubsub_reader.cancel()
+        pass
+    finally:
+        ws_hub.unregister(client)
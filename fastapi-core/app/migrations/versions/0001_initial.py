@@ -0,0 +1,68 @@
+"""initial
+
+Revision ID: 0001
+Revises:
+Create Date: 2025-01-20 12:00:00.000000
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0001"
+down_revision: str | None = None
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Databases created before migrations already have these tables from create_all
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table("sources"):
+        op.create_table(
+            "sources",
+            sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column("name", sa.String(length=30), nullable=False),
+            sa.Column("link", sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint("id")
+        )
+
+    if not inspector.has_table("krc20_transactions"):
+        op.create_table(
+            "krc20_transactions",
+            sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column("id_source", sa.Integer(), nullable=False),
+            sa.Column("ticker", sa.String(length=6), nullable=False),
+            sa.Column("krc20_amount", sa.Float(), nullable=False),
+            sa.Column("kas_amount", sa.Float(), nullable=False),
+            sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+            sa.ForeignKeyConstraint(["id_source"], ["sources.id"]),
+            sa.PrimaryKeyConstraint("id")
+        )
+
+    if not inspector.has_table("krc20_candles"):
+        op.create_table(
+            "krc20_candles",
+            sa.Column("ticker", sa.String(length=6), nullable=False),
+            sa.Column("interval", sa.String(length=3), nullable=False),
+            sa.Column("bucket", sa.DateTime(timezone=True), nullable=False),
+            sa.Column("open", sa.Float(), nullable=False),
+            sa.Column("high", sa.Float(), nullable=False),
+            sa.Column("low", sa.Float(), nullable=False),
+            sa.Column("close", sa.Float(), nullable=False),
+            sa.Column("volume_krc20", sa.Float(), nullable=False),
+            sa.Column("volume_kas", sa.Float(), nullable=False),
+            sa.Column("trades", sa.Integer(), nullable=False),
+            sa.Column("open_at", sa.DateTime(timezone=True), nullable=False),
+            sa.Column("close_at", sa.DateTime(timezone=True), nullable=False),
+            sa.PrimaryKeyConstraint("ticker", "interval", "bucket")
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("krc20_candles")
+    op.drop_table("krc20_transactions")
+    op.drop_table("sources")
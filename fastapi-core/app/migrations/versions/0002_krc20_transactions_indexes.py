@@ -0,0 +1,43 @@
+"""krc20_transactions indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2025-01-20 12:30:00.000000
+
+"""
+from typing import Sequence
+
+from alembic import op
+
+
+revision: str = "0002"
+down_revision: str | None = "0001"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_krc20_transactions_created_at",
+        "krc20_transactions",
+        ["created_at"],
+        if_not_exists=True
+    )
+    op.create_index(
+        "ix_krc20_transactions_id_source_created_at",
+        "krc20_transactions",
+        ["id_source", "created_at"],
+        if_not_exists=True
+    )
+    op.create_index(
+        "ix_krc20_transactions_ticker_created_at",
+        "krc20_transactions",
+        ["ticker", "created_at"],
+        if_not_exists=True
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_krc20_transactions_ticker_created_at", table_name="krc20_transactions")
+    op.drop_index("ix_krc20_transactions_id_source_created_at", table_name="krc20_transactions")
+    op.drop_index("ix_krc20_transactions_created_at", table_name="krc20_transactions")
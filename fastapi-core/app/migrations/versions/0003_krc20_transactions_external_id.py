@@ -0,0 +1,40 @@
+"""krc20_transactions external message id and per-source sync checkpoint
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2025-01-27 12:00:00.000000
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0003"
+down_revision: str | None = "0002"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Rows synced before this revision have no message id; NULLs never conflict
+    op.add_column("krc20_transactions", sa.Column("external_id", sa.BigInteger(), nullable=True))
+    op.create_unique_constraint(
+        "uq_krc20_transactions_id_source_external_id",
+        "krc20_transactions",
+        ["id_source", "external_id"]
+    )
+
+    op.add_column("sources", sa.Column("last_external_id", sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("sources", "last_external_id")
+
+    op.drop_constraint(
+        "uq_krc20_transactions_id_source_external_id",
+        "krc20_transactions",
+        type_="unique"
+    )
+    op.drop_column("krc20_transactions", "external_id")
@@ -0,0 +1,30 @@
+"""krc20_transactions price, buyer and tx hash
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2025-02-03 12:00:00.000000
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = "0004"
+down_revision: str | None = "0003"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Optional in the bot's messages and unknown for rows stored before this revision
+    op.add_column("krc20_transactions", sa.Column("price", sa.Float(), nullable=True))
+    op.add_column("krc20_transactions", sa.Column("buyer", sa.String(128), nullable=True))
+    op.add_column("krc20_transactions", sa.Column("tx_hash", sa.String(128), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("krc20_transactions", "tx_hash")
+    op.drop_column("krc20_transactions", "buyer")
+    op.drop_column("krc20_transactions", "price")
@@ -0,0 +1,119 @@
+"""
+Latency of the krc20_transactions hot queries before and after the 0002 indexes.
+
+Seeds a scratch schema (never the real tables) and prints median execution time
+reported by EXPLAIN ANALYZE for each query, without and with the indexes:
+
+    python bench/krc20_transactions_indexes.py --rows 5000000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection
+
+SCHEMA: str = "bench_krc20"
+
+QUERIES: dict[str, str] = {
+    "last transactions": (
+        f"SELECT * FROM {SCHEMA}.krc20_transactions ORDER BY created_at DESC LIMIT 100"
+    ),
+    "last transactions by source": (
+        f"SELECT * FROM {SCHEMA}.krc20_transactions WHERE id_source = 1 "
+        f"ORDER BY created_at DESC LIMIT 100"
+    ),
+    "last transactions by ticker": (
+        f"SELECT * FROM {SCHEMA}.krc20_transactions WHERE ticker = 'T42' "
+        f"ORDER BY created_at DESC LIMIT 100"
+    ),
+    "sync checkpoint": (
+        f"SELECT * FROM {SCHEMA}.krc20_transactions ORDER BY created_at DESC LIMIT 1"
+    )
+}
+
+INDEXES: list[str] = [
+    f"CREATE INDEX ON {SCHEMA}.krc20_transactions (created_at)",
+    f"CREATE INDEX ON {SCHEMA}.krc20_transactions (id_source, created_at)",
+    f"CREATE INDEX ON {SCHEMA}.krc20_transactions (ticker, created_at)"
+]
+
+
+async def seed(conn: AsyncConnection, rows: int, tickers: int):
+    await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+    await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    await conn.execute(text(f"""
+        CREATE TABLE {SCHEMA}.krc20_transactions (
+            id serial PRIMARY KEY,
+            id_source integer NOT NULL,
+            ticker varchar(6) NOT NULL,
+            krc20_amount double precision NOT NULL,
+            kas_amount double precision NOT NULL,
+            created_at timestamptz NOT NULL
+        )
+    """))
+    await conn.execute(text(f"""
+        INSERT INTO {SCHEMA}.krc20_transactions (id_source, ticker, krc20_amount, kas_amount, created_at)
+        SELECT
+            1 + (i % 3),
+            'T' || (i % {tickers}),
+            random() * 100000,
+            random() * 1000,
+            timestamptz '2025-01-01' + i * interval '1 second'
+        FROM generate_series(1, {rows}) AS i
+    """))
+    await conn.execute(text(f"ANALYZE {SCHEMA}.krc20_transactions"))
+
+
+async def measure(conn: AsyncConnection, repeat: int) -> dict[str, float]:
+    result: dict[str, float] = {}
+
+    for name, query in QUERIES.items():
+        timings: list[float] = []
+
+        for _ in range(repeat):
+            plan: list = (await conn.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}"))).scalar()
+            timings.append(plan[0]["Execution Time"])
+
+        result[name] = statistics.median(timings)
+
+    return result
+
+
+async def main():
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default=os.getenv(
+        "BENCH_DSN",
+        "postgresql+asyncpg://main:vHkSbSY&526_*22a@db/main"
+    ))
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--tickers", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args: argparse.Namespace = parser.parse_args()
+
+    engine = create_async_engine(args.dsn)
+
+    async with engine.begin() as conn:
+        print(f"Seeding {args.rows} rows..")
+        await seed(conn, args.rows, args.tickers)
+
+        before: dict[str, float] = await measure(conn, args.repeat)
+
+        for index in INDEXES:
+            await conn.execute(text(index))
+        await conn.execute(text(f"ANALYZE {SCHEMA}.krc20_transactions"))
+
+        after: dict[str, float] = await measure(conn, args.repeat)
+
+        await conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+
+    await engine.dispose()
+
+    print(f"{'query':<30}{'before, ms':>14}{'after, ms':>14}")
+    for name in QUERIES:
+        print(f"{name:<30}{before[name]:>14.3f}{after[name]:>14.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+"""
+Websocket load test for one or more fastapi-core replicas behind nginx.
+
+Opens connections in steps, then adds probe frames for the "bench" topic to the updates
+stream and reports connect latency and fan-out latency (XADD -> every client got it) per step:
+
+    python bench/ws_connections.py --url ws://localhost/ws --steps 1000,2000,4000,8000
+
+Run it once per replica count (docker compose up --scale fastapi-core=N); with the
+work spread over the replicas the fan-out time per step should stay flat as N grows
+with the connection count.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+import websockets
+from redis.asyncio.client import Redis
+
+TOPIC: str = "bench"
+
+
+class Client:
+    def __init__(self):
+        self.connection: websockets.ClientConnection | None = None
+        self.received: dict[int, float] = {}
+
+    async def connect(self, url: str) -> float:
+        started_at: float = time.perf_counter()
+        self.connection = await websockets.connect(f"{url}?topics={TOPIC}", max_queue=None)
+        # The first frame is always the (empty for this topic) snapshot
+        await self.connection.recv()
+
+        return time.perf_counter() - started_at
+
+    async def read(self):
+        async for message in self.connection:
+            frame: dict = json.loads(message)
+            if frame["method"] == TOPIC:
+                self.received[frame["data"]["probe"]] = time.perf_counter()
+
+
+def percentile(values: list[float], q: float) -> float:
+    return sorted(values)[min(len(values) - 1, int(len(values) * q))]
+
+
+async def probe(redis_client: Redis, clients: list[Client], number: int, timeout: float) -> float | None:
+    started_at: float = time.perf_counter()
+    await redis_client.xadd(
+        "updates",
+        {"topic": TOPIC, "frame": json.dumps({"v": 1, "method": TOPIC, "data": {"probe": number}})},
+        maxlen=10000,
+        approximate=True
+    )
+
+    while time.perf_counter() - started_at < timeout:
+        if all(number in client.received for client in clients):
+            return max(client.received[number] for client in clients) - started_at
+        await asyncio.sleep(0.005)
+
+    return None
+
+
+async def main():
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="ws://localhost/ws")
+    parser.add_argument("--redis", default=os.getenv("BENCH_REDIS", "redis://redis-server"))
+    parser.add_argument("--steps", default="500,1000,2000,4000")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--probes", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=10)
+    args: argparse.Namespace = parser.parse_args()
+
+    redis_client: Redis = Redis.from_url(args.redis)
+    clients: list[Client] = []
+    readers: list[asyncio.Task] = []
+    probe_number: int = 0
+
+    print(f"{'connections':>12}{'connect p50, ms':>18}{'connect p99, ms':>18}"
+          f"{'fan-out p50, ms':>18}{'fan-out max, ms':>18}{'lost':>6}")
+
+    try:
+        for step in map(int, args.steps.split(",")):
+            connect_timings: list[float] = []
+            semaphore: asyncio.Semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def connect(client: Client):
+                async with semaphore:
+                    connect_timings.append(await client.connect(args.url))
+
+            new_clients: list[Client] = [Client() for _ in range(step - len(clients))]
+            await asyncio.gather(*(connect(client) for client in new_clients))
+
+            clients.extend(new_clients)
+            readers.extend(asyncio.create_task(client.read()) for client in new_clients)
+
+            fan_out_timings: list[float] = []
+            lost: int = 0
+
+            for _ in range(args.probes):
+                probe_number += 1
+                elapsed: float | None = await probe(redis_client, clients, probe_number, args.timeout)
+
+                if elapsed is None:
+                    lost += 1
+                else:
+                    fan_out_timings.append(elapsed)
+
+            print(
+                f"{len(clients):>12}"
+                f"{statistics.median(connect_timings) * 1000 if connect_timings else 0:>18.1f}"
+                f"{percentile(connect_timings, 0.99) * 1000 if connect_timings else 0:>18.1f}"
+                f"{statistics.median(fan_out_timings) * 1000 if fan_out_timings else 0:>18.1f}"
+                f"{max(fan_out_timings, default=0) * 1000:>18.1f}"
+                f"{lost:>6}"
+            )
+    finally:
+        for reader in readers:
+            reader.cancel()
+
+        await asyncio.gather(*(client.connection.close() for client in clients), return_exceptions=True)
+        await redis_client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
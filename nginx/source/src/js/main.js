@@ -36,117 +36,29 @@ async function initApp() {
     }
 
     await initKasRatesChart();
+    await loadKASRatesHistory();
     await listenWS();
 }
 
 async function initKasRatesChart() {
+    let exchanges = [];
+    try {
+        const response = await fetch("/kas-rates/exchanges");
+        exchanges = await response.json();
+    } catch (error) {
+        console.error("ERROR KAS exchanges:", error);
+    }
+
     const data = {
-        datasets: [
-            {
-                label: "ByBit",
-                data: [],
-                borderColor: "#2F5BE1",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Kraken",
-                data: [],
-                borderColor: "#1F1F1F",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Kucoin",
-                data: [],
-                borderColor: "#00D1A7",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Mexc",
-                data: [],
-                borderColor: "#0C6EFF",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Coinex",
-                data: [],
-                borderColor: "#1DCE72",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Gate",
-                data: [],
-                borderColor: "#0D6EFD",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Digifinex",
-                data: [],
-                borderColor: "#FF6B6B",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Xeggex",
-                data: [],
-                borderColor: "#F7A800",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Uphold",
-                data: [],
-                borderColor: "#00C0D9",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Bitget",
-                data: [],
-                borderColor: "#3A87F7",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Lbank",
-                data: [],
-                borderColor: "#FF4C00",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Bydfi",
-                data: [],
-                borderColor: "#FF5B00",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            },
-            {
-                label: "Btse",
-                data: [],
-                borderColor: "#FF3366",
-                borderWidth: 0.4,
-                pointRadius: 2,
-                fill: false
-            }
-        ]
+        datasets: exchanges.map((exchange) => ({
+            name: exchange["name"],
+            label: exchange["label"],
+            data: [],
+            borderColor: exchange["color"],
+            borderWidth: 0.4,
+            pointRadius: 2,
+            fill: false
+        }))
     };
 
     const config = {
@@ -215,7 +127,36 @@ async function initKasRatesChart() {
     kasRatesChart = new Chart(document.getElementById("kasRatesChart").getContext("2d"), config);
 }
 
+async function loadKASRatesHistory() {
+    try {
+        const from = Date.now() - KAS_RATES_CHART_POINTS * KAS_RATES_INTERVAL;
+        const response = await fetch(`/kas-rates/history?from=${from}&points=${KAS_RATES_CHART_POINTS}`);
+        const history = await response.json();
+
+        for (const [exchange, points] of history["data"]) {
+            const dataset = kasRatesChart.data.datasets.find(ds => ds.name === exchange);
+            if (!dataset) continue;
+
+            dataset.data = points.map(([x, y]) => ({x, y}));
+        }
+
+        kasRatesChart.update();
+    } catch (error) {
+        console.error("ERROR KAS rates history:", error);
+    }
+}
+
 async function addLastKRC20Transaction(transaction) {
+    // Ids identify a transaction but do not grow in publish order, so duplicates
+    // (a snapshot overlapping live frames) are dropped by identity
+    const id = Number(transaction["id"]);
+    if (knownKRC20TransactionIds.has(id)) return;
+    knownKRC20TransactionIds.add(id);
+    if (knownKRC20TransactionIds.size > KRC20_KNOWN_IDS_LIMIT) {
+        knownKRC20TransactionIds.delete(knownKRC20TransactionIds.values().next().value);
+    }
+    lastKRC20TransactionId = id;
+
     await addKRC20Transaction({
         idSource: Number(await escapeHTML(transaction["id_source"])),
         ticker: await escapeHTML(transaction["ticker"]),
@@ -225,15 +166,34 @@ async function addLastKRC20Transaction(transaction) {
     });
 }
 
+async function applyKASRatesDelta(delta) {
+    for (const [name, price] of delta["data"]) {
+        kasRates.set(name, price);
+    }
+
+    await updateKASRates({
+        data: Array.from(kasRates.entries()),
+        timestamp: delta["timestamp"]
+    });
+}
+
 async function updateKASRates(rates) {
+    kasRates = new Map(rates["data"]);
+
     for (const rate of rates["data"]) {
-        const dataset = kasRatesChart.data.datasets.find(ds => ds.label.toLowerCase() === rate[0]);
+        const dataset = kasRatesChart.data.datasets.find(ds => ds.name === rate[0]);
+        if (!dataset) continue;
+
+        const last = dataset.data[dataset.data.length - 1];
+        // Streamed updates can arrive several times a second; keep the chart at one point per interval
+        if (last && rates["timestamp"] - last.x < KAS_RATES_INTERVAL) continue;
+
         dataset.data.push({
             x: rates["timestamp"],
             y: rate[1]
         });
     }
-    const allRates = rates["data"].flatMap(dataset => dataset[1]);
+    const allRates = rates["data"].map(rate => rate[1]).filter(rate => rate !== null);
     const minRate = Math.min(...allRates);
     const maxRate = Math.max(...allRates);
 
@@ -246,12 +206,11 @@ async function updateKASRates(rates) {
     kasRatesChart.options.scales.y.suggestedMin = suggestedMin;
     kasRatesChart.options.scales.y.suggestedMax = suggestedMax;
 
-    const totalPoints = kasRatesChart.data.datasets[0].data.length;
-    if (totalPoints > 25) {
-        kasRatesChart.data.datasets.forEach((dataset) => {
+    kasRatesChart.data.datasets.forEach((dataset) => {
+        while (dataset.data.length > KAS_RATES_CHART_POINTS) {
             dataset.data.shift();
-        });
-    }
+        }
+    });
 
     kasRatesChart.update();
 
@@ -263,30 +222,70 @@ async function updateKASRates(rates) {
     for (const rate of rates["data"]) {
         if (rate[1] === null) continue;
         const spanEl = document.getElementById(`kas-live__dropdown-${rate[0]}`);
+        if (!spanEl) continue;
         spanEl.innerText = "$" + rate[1].toFixed(5);
     }
 }
 
 async function listenWS() {
     try {
-        const url = await getWebSocketURL();
+        const params = new URLSearchParams();
+        if (lastKRC20TransactionId !== null) {
+            params.set("since", lastKRC20TransactionId);
+        }
+        // Resumes from the last event seen, the server replays what was missed
+        if (lastEventId !== null) {
+            params.set("last_event_id", lastEventId);
+        }
+
+        let url = await getWebSocketURL();
+        if (params.toString() !== "") {
+            url += `?${params}`;
+        }
         const socket = new WebSocket(url);
 
         socket.addEventListener("message", async (event) => {
-            const data = JSON.parse(event.data);
-            const dataContent = JSON.parse(data["data"]);
+            const frame = JSON.parse(event.data);
+            if (frame["v"] !== WS_FRAME_VERSION) return;
+            if (frame["id"] !== undefined) {
+                lastEventId = frame["id"];
+            }
 
-            if (data["method"] === "last_krc20_transaction") {
-                await addLastKRC20Transaction(dataContent);
-            } else if (data["method"] === "kas-rates") {
-                await updateKASRates(dataContent);
+            if (frame["method"] === "snapshot") {
+                await applySnapshot(frame["data"]);
+            } else if (frame["method"] === "last_krc20_transaction") {
+                await addLastKRC20Transaction(frame["data"]);
+            } else if (frame["method"] === "kas-rates") {
+                await updateKASRates(frame["data"]);
+            } else if (frame["method"] === "kas-rates-delta") {
+                await applyKASRatesDelta(frame["data"]);
             }
         });
+
+        socket.addEventListener("close", () => {
+            setTimeout(listenWS, WS_RECONNECT_DELAY + Math.random() * WS_RECONNECT_DELAY);
+        });
     } catch (error) {
         console.error("ERROR WebSocket:", error);
     }
 }
 
+async function applySnapshot(snapshot) {
+    if (snapshot["full"]) {
+        document.getElementById("krc20Transactions").replaceChildren();
+        knownKRC20TransactionIds.clear();
+        lastKRC20TransactionId = null;
+    }
+
+    for (const transaction of snapshot["transactions"]) {
+        await addLastKRC20Transaction(transaction);
+    }
+
+    if (snapshot["kas_rates"] !== null) {
+        await updateKASRates(snapshot["kas_rates"]);
+    }
+}
+
 async function getWSProtocol() {
     if (window.location.protocol === "https:") {
         return "wss";
@@ -375,4 +374,15 @@ async function addKRC20Transaction({idSource, ticker, krc20Amount, kasAmount, cr
     }
 }
 
-let kasRatesChart;
\ No newline at end of file
+const WS_FRAME_VERSION = 1;
+const WS_RECONNECT_DELAY = 2000;
+const KRC20_KNOWN_IDS_LIMIT = 1000;
+const KAS_RATES_CHART_POINTS = 25;
+const KAS_RATES_INTERVAL = 5000;
+
+let kasRatesChart;
+let kasRates = new Map();
+// Id of the last transaction added, sent back as ?since= to get only what followed it
+let lastKRC20TransactionId = null;
+let knownKRC20TransactionIds = new Set();
+let lastEventId = null;
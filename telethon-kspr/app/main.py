@@ -1,23 +1,45 @@
 import re
 import asyncio
 import logging
+import logging.handlers
+import queue
+import atexit
 import json
+import math
 import os
+import time
+
+from abc import ABC, abstractmethod
+from asyncio.tasks import Task
 
 from datetime import datetime, timezone
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 from telethon import TelegramClient, events
 from telethon.tl.custom.message import Message
 from telethon.tl.types import TypePeer, PeerChannel, PeerUser
 
 from sqlalchemy import (
+    BigInteger,
     DateTime,
     String,
     Float,
     Integer,
     ForeignKey,
-    select
+    Index,
+    UniqueConstraint,
+    select,
+    update,
+    case,
+    func,
+    text
 )
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -28,10 +50,12 @@ from sqlalchemy.ext.asyncio import (
     create_async_engine,
     AsyncEngine,
     async_sessionmaker,
+    AsyncSession,
     AsyncAttrs
 )
 
 from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -40,6 +64,12 @@ class Base(AsyncAttrs, DeclarativeBase):
 
 class KRC20Transaction(Base):
     __tablename__ = "krc20_transactions"
+    __table_args__ = (
+        Index("ix_krc20_transactions_created_at", "created_at"),
+        Index("ix_krc20_transactions_id_source_created_at", "id_source", "created_at"),
+        Index("ix_krc20_transactions_ticker_created_at", "ticker", "created_at"),
+        UniqueConstraint("id_source", "external_id", name="uq_krc20_transactions_id_source_external_id")
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     id_source: Mapped[int] = mapped_column(Integer, ForeignKey("sources.id"), nullable=False)
@@ -50,6 +80,12 @@ class KRC20Transaction(Base):
         DateTime(timezone=True),
         nullable=False
     )
+    # Message id in the source (Telegram message id for the KSPR bot)
+    external_id: Mapped[int | None] = mapped_column(BigInteger)
+    # Posted by the KSPR bot along with the amounts, not by every source
+    price: Mapped[float | None] = mapped_column(Float)
+    buyer: Mapped[str | None] = mapped_column(String(128))
+    tx_hash: Mapped[str | None] = mapped_column(String(128))
 
     source: Mapped["Source"] = relationship(back_populates="krc20_transactions")
 
@@ -60,36 +96,155 @@ class Source(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     name: Mapped[str] = mapped_column(String(30), nullable=False)
     link: Mapped[str | None] = mapped_column(String)
+    # Newest external_id written from this source, where the next sync resumes
+    last_external_id: Mapped[int | None] = mapped_column(BigInteger)
 
     krc20_transactions: Mapped[list["KRC20Transaction"]] = relationship(back_populates="source")
 
 
+class KRC20Candle(Base):
+    __tablename__ = "krc20_candles"
+
+    ticker: Mapped[str] = mapped_column(String(6), primary_key=True)
+    interval: Mapped[str] = mapped_column(String(3), primary_key=True)
+    bucket: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
+    open: Mapped[float] = mapped_column(Float, nullable=False)
+    high: Mapped[float] = mapped_column(Float, nullable=False)
+    low: Mapped[float] = mapped_column(Float, nullable=False)
+    close: Mapped[float] = mapped_column(Float, nullable=False)
+    volume_krc20: Mapped[float] = mapped_column(Float, nullable=False)
+    volume_kas: Mapped[float] = mapped_column(Float, nullable=False)
+    trades: Mapped[int] = mapped_column(Integer, nullable=False)
+    open_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    close_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+
+        if getattr(record, "repeated", 0):
+            entry["repeated"] = record.repeated
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RepeatSampler(logging.Filter):
+    """Passes a repeated warning or error once per window, with the count of dropped repeats."""
+
+    def __init__(self, window: float, max_keys: int = 10000):
+        super().__init__()
+        self.window: float = window
+        self.max_keys: int = max_keys
+        # Sampling key (see get_key) -> [time.monotonic() of the last pass, dropped since]
+        self.seen: dict[tuple, list] = {}
+
+    @staticmethod
+    def get_key(record: logging.LogRecord) -> tuple:
+        # The call site rather than the message, which usually embeds per-attempt
+        # detail (ids, URLs, exception reprs) and would never repeat. A log call
+        # shared by several subjects passes extra={"sample_key": ...} to keep them apart.
+        return (
+            record.name,
+            record.levelno,
+            record.pathname,
+            record.lineno,
+            record.exc_info[0] if record.exc_info else None,
+            getattr(record, "sample_key", None)
+        )
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+
+        key: tuple = self.get_key(record)
+        now: float = time.monotonic()
+        seen: list | None = self.seen.get(key)
+
+        if seen is not None and now - seen[0] < self.window:
+            seen[1] += 1
+            return False
+
+        if seen is not None:
+            record.repeated = seen[1]
+        elif len(self.seen) >= self.max_keys:
+            self.seen.clear()
+
+        self.seen[key] = [now, 0]
+        return True
+
+
 config: dict = {
     "last_krc20_transactions_count": 100,
-    "last_krc20_transactions_kspr_count": 100
+    "last_krc20_transactions_source_count": 100,
+    "krc20_trades_key": "krc20:trades:{}",
+    "krc20_trades_per_ticker": 1000,
+    "last_krc20_transactions_key": "krc20:last_transactions",
+    "last_krc20_transactions_source_key": "krc20:last_transactions:source:{}",
+    "krc20_candle_intervals": {
+        "1m": 60,
+        "5m": 5 * 60,
+        "1h": 60 * 60,
+        "1d": 24 * 60 * 60
+    },
+    "ws_frame_version": 1,
+    "updates_stream_key": "updates",
+    "updates_stream_maxlen": 10000,
+    "krc20_candles_insert_chunk": 1000,
+    "sync_chunk_size": 1000,
+    "writer_queue_size": 10000,
+    "writer_batch_size": 50,
+    "writer_batch_timeout": 0.1,
+    "writer_retry_delay": 1,
+    # Ids reserved from the table sequence at a time; a new block is fetched in the
+    # background once fewer than this many are left
+    "writer_id_block_size": 50,
+    "ingestor_queue_size": 1000,
+    "metrics_port": 9102,
+    "log_max_bytes": 10 * 1024 * 1024,
+    "log_backup_count": 5,
+    "log_sample_window": 60
 }
 
-logging.basicConfig(
-    filename="app.log",
-    format="[%(levelname)s] %(asctime)s: %(name)s %(message)s",
-    level=logging.WARNING
+# Handlers do their I/O on the listener thread, the event loop only puts records on a queue
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+queue_handler: logging.handlers.QueueHandler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(RepeatSampler(config["log_sample_window"]))
+# QueueHandler merges the traceback into the message before enqueueing, so the
+# JSON formatter never sees exc_info; "%(message)s" keeps basicConfig from adding its own format
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+file_handler: logging.handlers.RotatingFileHandler = logging.handlers.RotatingFileHandler(
+    "app.log",
+    maxBytes=config["log_max_bytes"],
+    backupCount=config["log_backup_count"],
+    encoding="utf-8"
 )
-
-app_logger: logging.Logger = logging.getLogger("app_logger")
-file_handler: logging.FileHandler = logging.FileHandler("app.log")
 console_handler: logging.StreamHandler = logging.StreamHandler()
-formatter: logging.Formatter = logging.Formatter("[%(levelname)s] %(asctime)s: %(name)s %(message)s")
 
-app_logger.setLevel(logging.DEBUG)
 file_handler.setLevel(logging.INFO)
 console_handler.setLevel(logging.DEBUG)
 
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+file_handler.setFormatter(JSONFormatter())
+console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s: %(name)s %(message)s"))
+
+log_listener: logging.handlers.QueueListener = logging.handlers.QueueListener(
+    log_queue, file_handler, console_handler, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
 
-app_logger.addHandler(file_handler)
-app_logger.addHandler(console_handler)
+# Library loggers (Telethon, SQLAlchemy, redis) go through the same queue
+logging.basicConfig(level=logging.WARNING, handlers=[queue_handler])
 
+app_logger: logging.Logger = logging.getLogger("app_logger")
+app_logger.setLevel(logging.DEBUG)
+app_logger.addHandler(queue_handler)
 app_logger.propagate = False
 
 engine: AsyncEngine = create_async_engine(
@@ -100,181 +255,822 @@ async_session: async_sessionmaker = async_sessionmaker(engine, expire_on_commit=
 api_id: int = 25341299
 api_hash: str = "6594f728fbae8e3a7ede766ef7c494bd"
 client: TelegramClient = TelegramClient(os.getenv("TG_SESSION_FILE_NAME", "profile-dev"), api_id, api_hash)
-is_synced: bool = False
 
+message_parse_seconds: Histogram = Histogram(
+    "krc20_message_parse_seconds", "Time to parse a source message", ["source"],
+    buckets=(.00001, .00005, .0001, .0005, .001, .005, .01)
+)
+message_publish_seconds: Histogram = Histogram(
+    "krc20_message_publish_seconds", "Time to publish a transaction to Redis", ["source"]
+)
+messages_skipped: Counter = Counter(
+    "krc20_messages_skipped", "Source messages that could not be parsed", ["source"]
+)
+ingestor_queue_depth: Gauge = Gauge(
+    "krc20_ingestor_queue_depth", "Live messages waiting for their ingestor", ["source"]
+)
+writer_flush_seconds: Histogram = Histogram(
+    "krc20_writer_flush_seconds", "Time to insert a batch of transactions and update candles"
+)
+writer_insert_delay_seconds: Histogram = Histogram(
+    "krc20_writer_insert_delay_seconds", "Time from a transaction being queued to its row being committed"
+)
+writer_flushed_rows: Counter = Counter(
+    "krc20_writer_flushed_rows", "Transactions written by the writer"
+)
+writer_dropped_rows: Counter = Counter(
+    "krc20_writer_dropped_rows", "Transactions Postgres rejected, logged and skipped"
+)
+writer_flush_errors: Counter = Counter(
+    "krc20_writer_flush_errors", "Failed writer flushes (each is retried)"
+)
+writer_id_errors: Counter = Counter(
+    "krc20_writer_id_errors", "Failed id reservations (each is retried)"
+)
+writer_queue_depth: Gauge = Gauge(
+    "krc20_writer_queue_depth", "Transactions waiting for the writer"
+)
 redis_client: Redis = Redis(host="redis-server", decode_responses=True)
 
 
+class KRC20TransactionWriter:
+    def __init__(self):
+        # (transaction, time.perf_counter() of put)
+        self.queue: asyncio.Queue[tuple[dict, float]] = asyncio.Queue(maxsize=config["writer_queue_size"])
+        self.task: Task | None = None
+        self.id_task: Task | None = None
+        self.ids: deque[int] = deque()
+        # Set when the ids run low / when a block was added
+        self.ids_wanted: asyncio.Event = asyncio.Event()
+        self.ids_added: asyncio.Event = asyncio.Event()
+
+        writer_queue_depth.set_function(self.queue.qsize)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        self.id_task = asyncio.create_task(self.reserve_ids())
+
+    async def next_id(self) -> int:
+        # Ids are reserved from the table sequence ahead of time, so a transaction is
+        # published with its final id before the row is written and without a Postgres
+        # round trip. Only when Postgres has been down long enough to use up the
+        # reserve does this wait, like put() does on a full queue.
+        while not self.ids:
+            self.ids_added.clear()
+            self.ids_wanted.set()
+            await self.ids_added.wait()
+
+        if len(self.ids) <= config["writer_id_block_size"]:
+            self.ids_wanted.set()
+
+        return self.ids.popleft()
+
+    async def reserve_ids(self):
+        # The only task taking blocks, so they are queued in sequence order
+        self.ids_wanted.set()
+
+        while True:
+            await self.ids_wanted.wait()
+
+            try:
+                async with async_session() as session:
+                    self.ids.extend((await session.execute(
+                        text(
+                            "SELECT nextval(pg_get_serial_sequence('krc20_transactions', 'id')) "
+                            "FROM generate_series(1, :count)"
+                        ),
+                        {"count": config["writer_id_block_size"]}
+                    )).scalars().all())
+            except Exception as exc:
+                writer_id_errors.inc()
+                app_logger.error(f"Writer could not reserve ids, retrying: {exc}")
+                await asyncio.sleep(config["writer_retry_delay"])
+                continue
+
+            self.ids_added.set()
+            if len(self.ids) > config["writer_id_block_size"]:
+                self.ids_wanted.clear()
+
+    async def put(self, transaction: dict):
+        await self.queue.put((transaction, time.perf_counter()))
+
+    async def run(self):
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        while True:
+            batch: list[tuple[dict, float]] = [await self.queue.get()]
+            deadline: float = loop.time() + config["writer_batch_timeout"]
+
+            while len(batch) < config["writer_batch_size"]:
+                timeout: float = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self.flush(batch)
+
+    async def flush(self, batch: list[tuple[dict, float]]):
+        transactions: list[dict] = [transaction for transaction, _ in batch]
+        dropped: int = 0
+        started_at: float = time.perf_counter()
+
+        try:
+            await store_krc20_transactions_retrying(transactions)
+        except Exception as exc:
+            # Not Postgres being away but a row it rejects: retrying the batch would stall
+            # every source behind it, so the rows go one by one and only the bad ones are lost
+            writer_flush_errors.inc()
+            app_logger.error(f"Writer batch rejected, storing row by row: {exc!r}")
+
+            for transaction in transactions:
+                try:
+                    await store_krc20_transactions_retrying([transaction])
+                except Exception as row_exc:
+                    dropped += 1
+                    writer_dropped_rows.inc()
+                    app_logger.error(f"Writer dropped transaction {transaction}: {row_exc!r}")
+
+        flushed_at: float = time.perf_counter()
+        flush_latency: float = flushed_at - started_at
+
+        writer_flush_seconds.observe(flush_latency)
+        writer_flushed_rows.inc(len(batch) - dropped)
+        for _, queued_at in batch:
+            writer_insert_delay_seconds.observe(flushed_at - queued_at)
+
+        app_logger.debug(
+            f"Writer flushed {len(batch)} transactions in {flush_latency * 1000:.1f}ms, "
+            f"queue depth {self.queue.qsize()}"
+        )
+
+
+def is_transient_db_error(exc: Exception) -> bool:
+    if isinstance(exc, DBAPIError) and exc.connection_invalidated:
+        return True
+    return isinstance(exc, (OperationalError, InterfaceError, OSError, asyncio.TimeoutError))
+
+
+async def store_krc20_transactions_retrying(transactions: list[dict]):
+    while True:
+        try:
+            async with async_session() as session:
+                await store_krc20_transactions(session, transactions)
+                await session.commit()
+            return
+        except Exception as exc:
+            if not is_transient_db_error(exc):
+                raise
+
+            # Kept and retried; while Postgres is down the queue fills up
+            # and put() starts applying backpressure to the ingestors
+            writer_flush_errors.inc()
+            app_logger.error(f"Writer flush error, retrying: {exc!r}")
+            await asyncio.sleep(config["writer_retry_delay"])
+
+
+krc20_writer: KRC20TransactionWriter = KRC20TransactionWriter()
+
+
 @client.on(events.NewMessage())
 async def new_message(event: events.NewMessage.Event):
-    global is_synced
-
     message: Message = event.message
     peer_id: TypePeer = message.peer_id
-    from_id: TypePeer | None = message.from_id
-    message_text: str = message.message
 
-    if not is_synced:
+    if not isinstance(peer_id, PeerChannel):
         return
 
-    if not isinstance(peer_id, PeerChannel) or not isinstance(from_id, PeerUser):
-        return
+    for ingestor in telegram_ingestors.get(peer_id.channel_id, ()):
+        if ingestor.matches(message):
+            # Blocks this update's task while the ingestor is behind, not the other sources
+            await ingestor.queue.put(message)
+
+
+def aggregate_krc20_candles(transactions: list[dict]) -> list[dict]:
+    candles: dict[tuple[str, str, int], dict] = {}
+
+    for transaction in transactions:
+        if transaction["krc20_amount"] <= 0:
+            continue
+
+        price: float = transaction["kas_amount"] / transaction["krc20_amount"]
+        created_at: datetime = transaction["created_at"]
+        timestamp: int = int(created_at.timestamp())
+
+        for interval, seconds in config["krc20_candle_intervals"].items():
+            bucket: int = timestamp - timestamp % seconds
+            candle: dict | None = candles.get((transaction["ticker"], interval, bucket))
+
+            if candle is None:
+                candles[(transaction["ticker"], interval, bucket)] = {
+                    "ticker": transaction["ticker"],
+                    "interval": interval,
+                    "bucket": datetime.fromtimestamp(bucket, timezone.utc),
+                    "open": price,
+                    "high": price,
+                    "low": price,
+                    "close": price,
+                    "volume_krc20": transaction["krc20_amount"],
+                    "volume_kas": transaction["kas_amount"],
+                    "trades": 1,
+                    "open_at": created_at,
+                    "close_at": created_at
+                }
+                continue
+
+            if created_at < candle["open_at"]:
+                candle["open"] = price
+                candle["open_at"] = created_at
+            if created_at >= candle["close_at"]:
+                candle["close"] = price
+                candle["close_at"] = created_at
+
+            candle["high"] = max(candle["high"], price)
+            candle["low"] = min(candle["low"], price)
+            candle["volume_krc20"] += transaction["krc20_amount"]
+            candle["volume_kas"] += transaction["kas_amount"]
+            candle["trades"] += 1
+
+    return list(candles.values())
+
+
+async def update_krc20_candles(session: AsyncSession, transactions: list[dict]):
+    candles: list[dict] = aggregate_krc20_candles(transactions)
+    chunk: int = config["krc20_candles_insert_chunk"]
+
+    for i in range(0, len(candles), chunk):
+        stmt = insert(KRC20Candle).values(candles[i:i + chunk])
+        excluded = stmt.excluded
+
+        # Merging is order independent, so late or replayed trades still give the right candle
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[KRC20Candle.ticker, KRC20Candle.interval, KRC20Candle.bucket],
+            set_={
+                "open": case(
+                    (excluded.open_at < KRC20Candle.open_at, excluded.open),
+                    else_=KRC20Candle.open
+                ),
+                "close": case(
+                    (excluded.close_at >= KRC20Candle.close_at, excluded.close),
+                    else_=KRC20Candle.close
+                ),
+                "high": func.greatest(KRC20Candle.high, excluded.high),
+                "low": func.least(KRC20Candle.low, excluded.low),
+                "volume_krc20": KRC20Candle.volume_krc20 + excluded.volume_krc20,
+                "volume_kas": KRC20Candle.volume_kas + excluded.volume_kas,
+                "trades": KRC20Candle.trades + excluded.trades,
+                "open_at": func.least(KRC20Candle.open_at, excluded.open_at),
+                "close_at": func.greatest(KRC20Candle.close_at, excluded.close_at)
+            }
+        ))
+
+
+async def init_krc20_candles():
+    async with async_session() as session:
+        if (await session.execute(select(KRC20Candle.ticker).limit(1))).scalar() is not None:
+            return
+
+        app_logger.info("Candles not found - building from krc20 transactions")
+
+        result = await session.stream(
+            select(
+                KRC20Transaction.ticker,
+                KRC20Transaction.krc20_amount,
+                KRC20Transaction.kas_amount,
+                KRC20Transaction.created_at
+            ).execution_options(yield_per=config["krc20_candles_insert_chunk"])
+        )
+
+        async for rows in result.mappings().partitions():
+            await update_krc20_candles(session, [dict(row) for row in rows])
+
+        await session.commit()
 
-    if peer_id.channel_id != 2193761946 or from_id.user_id != 7338170991:
+
+def build_frame(method: str, data: str) -> str:
+    return f'{{"v":{config["ws_frame_version"]},"method":{json.dumps(method)},"data":{data}}}'
+
+
+def publish_update(pipe: Pipeline, topic: str, frame: str):
+    # A capped stream instead of PUBLISH: the entry id becomes the event id the
+    # websocket clients resume from, and a burst waits in the stream for the readers.
+    pipe.xadd(
+        config["updates_stream_key"],
+        {"topic": topic, "frame": frame},
+        maxlen=config["updates_stream_maxlen"],
+        approximate=True
+    )
+
+
+async def send_krc20_transaction_to_redis(message_data: dict):
+    await send_krc20_transactions_to_redis([message_data])
+
+
+def krc20_transaction_to_redis(transaction: dict) -> str:
+    # Same fields in the same order as fastapi-core rebuilds them from Postgres, so
+    # a trade is the same sorted set member whether it was published or rebuilt
+    return json.dumps({
+        "id": transaction["id"],
+        "id_source": transaction["id_source"],
+        "ticker": transaction["ticker"],
+        "krc20_amount": transaction["krc20_amount"],
+        "kas_amount": transaction["kas_amount"],
+        "price": transaction.get("price"),
+        "buyer": transaction.get("buyer"),
+        "tx_hash": transaction.get("tx_hash"),
+        "created_at": transaction["created_at"]
+    }, separators=(",", ":"))
+
+
+def add_krc20_trades(pipe: Pipeline, transactions: list[dict], transactions_json: list[str]):
+    # Per-ticker index of recent trades, capped to the newest krc20_trades_per_ticker
+    for transaction, transaction_json in zip(transactions, transactions_json):
+        pipe.zadd(
+            config["krc20_trades_key"].format(transaction["ticker"]),
+            {transaction_json: transaction["created_at"]}
+        )
+    for ticker in {transaction["ticker"] for transaction in transactions}:
+        pipe.zremrangebyrank(
+            config["krc20_trades_key"].format(ticker), 0, -config["krc20_trades_per_ticker"] - 1
+        )
+
+
+async def send_krc20_trades_to_redis(transactions: list[dict]):
+    if not transactions:
         return
 
-    message_data: dict | None = await get_message_data(message_text)
-    if message_data is None:
-        app_logger.warning(f"Skip new message: {message_text}")
+    async with redis_client.pipeline(transaction=True) as pipe:
+        add_krc20_trades(pipe, transactions, [
+            krc20_transaction_to_redis(transaction) for transaction in transactions
+        ])
+        await pipe.execute()
+
+
+async def send_krc20_transactions_to_redis(transactions: list[dict], add_trades: bool = True):
+    # Transactions go oldest first, so the newest one ends up at the head of the lists
+    if not transactions:
         return
 
-    message_data["id_source"] = 1
-    message_data["created_at"] = message.date
+    transactions_json: list[str] = [krc20_transaction_to_redis(transaction) for transaction in transactions]
 
-    async with async_session() as session:
-        new_transaction: KRC20Transaction = KRC20Transaction(
-            id_source=message_data["id_source"],
-            ticker=message_data["ticker"],
-            krc20_amount=message_data["krc20_amount"],
-            kas_amount=message_data["kas_amount"],
-            created_at=message_data["created_at"]
-        )
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lpush(config["last_krc20_transactions_key"], *transactions_json)
+        pipe.ltrim(config["last_krc20_transactions_key"], 0, config["last_krc20_transactions_count"] - 1)
 
-        session.add(new_transaction)
-        await session.commit()
+        for id_source in {transaction["id_source"] for transaction in transactions}:
+            source_key: str = config["last_krc20_transactions_source_key"].format(id_source)
+            pipe.lpush(source_key, *[
+                transaction_json for transaction, transaction_json in zip(transactions, transactions_json)
+                if transaction["id_source"] == id_source
+            ])
+            pipe.ltrim(source_key, 0, config["last_krc20_transactions_source_count"] - 1)
 
-    message_data["created_at"] = int(message.date.timestamp() * 1000)
-    await send_krc20_transaction_to_redis(message_data)
+        if add_trades:
+            add_krc20_trades(pipe, transactions, transactions_json)
 
-    app_logger.info("Added new transaction")
-    app_logger.debug(message_text)
+        for transaction, transaction_json in zip(transactions, transactions_json):
+            publish_update(
+                pipe,
+                f"krc20:{transaction['ticker']}",
+                build_frame("last_krc20_transaction", transaction_json)
+            )
 
+        await pipe.execute()
 
-async def send_krc20_transaction_to_redis(message_data: dict):
-    message_data_json: str = json.dumps(message_data)
-    data: str = json.dumps({
-        "method": "last_krc20_transaction",
-        "data": message_data_json
-    })
 
-    await redis_client.lpush("last_krc20_transactions_kspr", message_data_json)
-    await redis_client.lpush("last_krc20_transactions", message_data_json)
+# The bot's message layout, matched in one search. Anything before a label on its
+# line (emoji) is skipped; price, buyer and tx hash are optional.
+kspr_message_pattern: re.Pattern = re.compile(
+    r"Ticker: ([^\n]*)\n[^\n:]*KRC20 Amount: ([^\n]*)\n[^\n:]*KAS Amount: ([^\n]*)"
+    r"(?:\n[^\n:]*Price: ([^\n]*))?"
+    r"(?:\n[^\n:]*Buyer: ([^\n]*))?"
+    r"(?:\n[^\n:]*Tx Hash: ([^\n]*))?"
+)
+
+kspr_message_fields: dict[str, str] = {
+    "Ticker": "ticker",
+    "KRC20 Amount": "krc20_amount",
+    "KAS Amount": "kas_amount",
+    "Price": "price",
+    "Buyer": "buyer",
+    "Tx Hash": "tx_hash"
+}
+
+
+def get_message_fields(message_text: str) -> dict[str, str]:
+    # Fallback for messages whose fields are reordered or interleaved with other lines
+    fields: dict[str, str] = {}
+
+    for line in message_text.split("\n"):
+        label, separator, value = line.partition(":")
+        if not separator:
+            continue
+
+        key: str | None = kspr_message_fields.get(label)
+        if key is None:
+            key = kspr_message_fields.get(label[label.find(" ") + 1:])
 
-    if (await redis_client.llen("last_krc20_transactions_kspr")) > config["last_krc20_transactions_kspr_count"]:
-        await redis_client.rpop("last_krc20_transactions_kspr")
+        if key is not None and key not in fields:
+            fields[key] = value.strip()
 
-    if (await redis_client.llen("last_krc20_transactions")) > config["last_krc20_transactions_count"]:
-        await redis_client.rpop("last_krc20_transactions")
+    return fields
 
-    await redis_client.publish("updates", data)
 
+def parse_amount(value: str) -> float:
+    # "1,250,000 NACHO" -> 1250000.0
+    amount: float = float(value.partition(" ")[0].replace(",", ""))
 
-async def get_message_data(message_text: str) -> dict | None:
-    ticker_pattern: str = r"Ticker: (.+?)\n"
-    krc20_amount_pattern: str = r"KRC20 Amount: (.+?)\n"
-    kas_amount_pattern: str = r"KAS Amount: (.+?)\n"
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError(value)
+
+    return amount
+
+
+def get_message_data(message_text: str | None) -> dict | None:
+    if not message_text:
+        return None
+
+    match: re.Match | None = kspr_message_pattern.search(message_text)
+
+    if match is not None:
+        ticker, krc20_amount, kas_amount, price, buyer, tx_hash = match.groups()
+    else:
+        fields: dict[str, str] = get_message_fields(message_text)
+        ticker, krc20_amount, kas_amount, price, buyer, tx_hash = (
+            fields.get(key) for key in ("ticker", "krc20_amount", "kas_amount", "price", "buyer", "tx_hash")
+        )
+
+    if ticker is None or krc20_amount is None or kas_amount is None:
+        return None
+
+    ticker = ticker.strip()
+    if not 0 < len(ticker) <= 6:
+        return None
 
     try:
-        ticker: str = re.search(ticker_pattern, message_text).group(1)
-        krc20_amount: float = float(re.search(krc20_amount_pattern, message_text).group(1))
-        kas_amount: float = float(re.search(kas_amount_pattern, message_text).group(1))
-    except AttributeError:
+        message_data: dict = {
+            "ticker": ticker,
+            "krc20_amount": parse_amount(krc20_amount),
+            "kas_amount": parse_amount(kas_amount)
+        }
+    except ValueError:
         return None
 
-    return {
-        "ticker": ticker,
-        "krc20_amount": krc20_amount,
-        "kas_amount": kas_amount
+    if price is not None:
+        try:
+            message_data["price"] = parse_amount(price)
+        except ValueError:
+            pass
+
+    # Dropped rather than truncated when longer than the column
+    if buyer is not None and 0 < len(buyer.strip()) <= 128:
+        message_data["buyer"] = buyer.strip()
+    if tx_hash is not None and 0 < len(tx_hash.strip()) <= 128:
+        message_data["tx_hash"] = tx_hash.strip()
+
+    return message_data
+
+
+def krc20_transaction_row(transaction: dict) -> dict:
+    row: dict = {
+        "id_source": transaction["id_source"],
+        "ticker": transaction["ticker"],
+        "krc20_amount": transaction["krc20_amount"],
+        "kas_amount": transaction["kas_amount"],
+        "created_at": transaction["created_at"]
+    }
+
+    for key in ("id", "external_id", "price", "buyer", "tx_hash"):
+        if key in transaction:
+            row[key] = transaction[key]
+
+    return row
+
+
+async def store_krc20_transactions(session: AsyncSession, transactions: list[dict]) -> list[dict]:
+    # Idempotent: a message stored before (same source and external_id, or the same
+    # reserved id on a retried flush) is skipped and does not count in the candles again
+    inserted: list = (await session.execute(
+        insert(KRC20Transaction).on_conflict_do_nothing().returning(
+            KRC20Transaction.id_source,
+            KRC20Transaction.external_id,
+            KRC20Transaction.id
+        ),
+        [krc20_transaction_row(transaction) for transaction in transactions]
+    )).all()
+
+    # Live rows carry the id reserved in emit() and are matched on it, external_id is
+    # optional for an ingestor. Synced rows get their id from the insert, they are
+    # matched on (id_source, external_id), which a sync always has.
+    inserted_ids: set[int] = {transaction_id for _, _, transaction_id in inserted}
+    synced_ids: dict[tuple[int, int], int] = {
+        (id_source, external_id): transaction_id
+        for id_source, external_id, transaction_id in inserted
+        if external_id is not None
     }
 
+    new_transactions: list[dict] = []
+    checkpoints: dict[int, int] = {}
 
-async def sync_krc20_transactions():
-    message: Message
+    for transaction in transactions:
+        id_source: int = transaction["id_source"]
+        external_id: int | None = transaction.get("external_id")
 
-    to_date: datetime = datetime(
-        2025,
-        1,
-        1,
-        0,
-        0,
-        0,
-        0,
-        timezone.utc
-    )
+        if "id" in transaction:
+            if transaction["id"] in inserted_ids:
+                new_transactions.append(transaction)
+        elif (id_source, external_id) in synced_ids:
+            transaction["id"] = synced_ids.pop((id_source, external_id))
+            new_transactions.append(transaction)
+
+        if external_id is not None:
+            checkpoints[id_source] = max(checkpoints.get(id_source, 0), external_id)
+
+    await update_krc20_candles(session, new_transactions)
 
-    app_logger.info("Started sync krc20 transactions")
+    for id_source, external_id in checkpoints.items():
+        await session.execute(update(Source).where(
+            Source.id == id_source
+        ).values(
+            last_external_id=func.greatest(func.coalesce(Source.last_external_id, 0), external_id)
+        ))
 
+    return new_transactions
+
+
+async def insert_krc20_transactions(transactions: list[dict]) -> list[dict]:
     async with async_session() as session:
-        last_transaction: KRC20Transaction | None = (await session.execute(
-            select(KRC20Transaction).order_by(KRC20Transaction.created_at.desc()).limit(1)
-        )).scalar()
-        last_transactions: list[dict] = []
+        new_transactions: list[dict] = await store_krc20_transactions(session, transactions)
+        await session.commit()
 
-        if last_transaction:
-            to_date = last_transaction.created_at
+    for transaction in new_transactions:
+        transaction["created_at"] = int(transaction["created_at"].timestamp() * 1000)
+
+    return new_transactions
+
+
+async def insert_synced_krc20_transactions(transactions: list[dict]) -> list[dict]:
+    # Indexed per committed chunk, the lists only keep the last few of a long backfill
+    new_transactions: list[dict] = await insert_krc20_transactions(transactions)
+    await send_krc20_trades_to_redis(new_transactions)
+
+    return new_transactions
+
+
+class Ingestor(ABC):
+    """A source of KRC20 trades; run() writes what it finds through the shared writer."""
+
+    def __init__(self, source_id: int, name: str, link: str | None):
+        self.source_id: int = source_id
+        self.name: str = name
+        self.link: str | None = link
+
+    async def register(self):
+        # The sources table follows the registry, fastapi-core only reads it
+        async with async_session() as session:
+            stmt = insert(Source).values(id=self.source_id, name=self.name, link=self.link)
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[Source.id],
+                set_={"name": stmt.excluded.name, "link": stmt.excluded.link}
+            ))
+            await session.commit()
+
+    @abstractmethod
+    async def run(self):
+        ...
+
+    async def emit(self, transaction: dict):
+        # Published right away, Postgres gets the row with the writer's next batch
+        transaction["id_source"] = self.source_id
+        transaction["id"] = await krc20_writer.next_id()
+
+        with message_publish_seconds.labels(self.name).time():
+            await send_krc20_transaction_to_redis({
+                **transaction,
+                "created_at": int(transaction["created_at"].timestamp() * 1000)
+            })
+
+        # Waits while the writer queue is full, which slows this source down first
+        await krc20_writer.put(transaction)
+
+
+@dataclass(frozen=True)
+class TelegramSource:
+    id: int
+    name: str
+    link: str | None
+    channel_id: int
+    # Only messages from this sender (a bot) are parsed, None for any sender
+    user_id: int | None
+    parse: Callable[[str | None], dict | None]
+    # History before this date is never synced
+    since: datetime = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+telegram_sources: list[TelegramSource] = [
+    TelegramSource(
+        id=1,
+        name="KSPR Bot",
+        link="https://t.me/kspr_home_bot?start=AXGfUlw",
+        channel_id=2193761946,
+        user_id=7338170991,
+        parse=get_message_data
+    )
+]
 
-        async for message in client.iter_messages(PeerChannel(2193761946)):
-            if message.from_id == PeerUser(7338170991):
-                break
 
-        async for message in client.iter_messages(
-                PeerChannel(2193761946),
-                from_user=PeerUser(7338170991)
-        ):
-            message_data: dict | None = await get_message_data(message.message)
+class TelegramIngestor(Ingestor):
+    """Syncs a channel's history by message id, then handles its live messages."""
 
-            if message_data is None:
+    def __init__(self, source: TelegramSource):
+        super().__init__(source.id, source.name, source.link)
+        self.source: TelegramSource = source
+        # Live messages, buffered from connect until the sync is done
+        self.queue: asyncio.Queue[Message] = asyncio.Queue(maxsize=config["ingestor_queue_size"])
+        ingestor_queue_depth.labels(self.name).set_function(self.queue.qsize)
+
+    def matches(self, message: Message) -> bool:
+        from_id: TypePeer | None = message.from_id
+
+        if self.source.user_id is None:
+            return True
+
+        return isinstance(from_id, PeerUser) and from_id.user_id == self.source.user_id
+
+    def parse(self, message: Message) -> dict | None:
+        with message_parse_seconds.labels(self.name).time():
+            transaction: dict | None = self.source.parse(message.message)
+
+        if transaction is None:
+            messages_skipped.labels(self.name).inc()
+            return None
+
+        transaction["id_source"] = self.source_id
+        transaction["external_id"] = message.id
+        transaction["created_at"] = message.date
+
+        return transaction
+
+    async def run(self):
+        synced_id: int = await self.sync()
+
+        # The sync already covered everything up to synced_id; the rest of what was
+        # buffered meanwhile is handled in order, so the hand-off leaves no gap
+        while True:
+            message: Message = await self.queue.get()
+
+            if message.id <= synced_id:
+                continue
+
+            transaction: dict | None = self.parse(message)
+            if transaction is None:
+                app_logger.warning(
+                    f"{self.name}: skip new message: {message.message}", extra={"sample_key": self.name}
+                )
+                continue
+
+            await self.emit(transaction)
+
+            app_logger.info(f"{self.name}: added new transaction")
+            app_logger.debug(message.message)
+
+    async def sync(self) -> int:
+        message: Message
+
+        app_logger.info(f"{self.name}: started sync krc20 transactions")
+
+        async with async_session() as session:
+            synced_id: int | None = (await session.execute(
+                select(Source.last_external_id).where(Source.id == self.source_id)
+            )).scalar()
+
+            last_created_at: datetime | None = None
+            if synced_id is None:
+                last_created_at = (await session.execute(
+                    select(func.max(KRC20Transaction.created_at)).where(
+                        KRC20Transaction.id_source == self.source_id
+                    )
+                )).scalar()
+
+        last_transactions: deque[dict] = deque(maxlen=config["last_krc20_transactions_count"])
+        chunk: list[dict] = []
+        synced_count: int = 0
+        started_at: float = time.perf_counter()
+
+        channel: PeerChannel = PeerChannel(self.source.channel_id)
+        from_user: PeerUser | None = None
+
+        if self.source.user_id is not None:
+            from_user = PeerUser(self.source.user_id)
+
+            # Puts the sender into the session's entity cache, iter_messages needs it
+            async for message in client.iter_messages(channel):
+                if message.from_id == from_user:
+                    break
+
+        if synced_id is not None:
+            # Everything after the last stored message id, oldest first
+            messages = client.iter_messages(channel, from_user=from_user, min_id=synced_id, reverse=True)
+        else:
+            # Rows stored before message ids were kept: resume once by date, from then on by id
+            last_created_at = last_created_at or self.source.since
+            messages = client.iter_messages(
+                channel,
+                from_user=from_user,
+                offset_date=last_created_at,
+                reverse=True
+            )
+
+        synced_id = synced_id or 0
+
+        # Oldest first with a commit per chunk, so after a crash the checkpoint
+        # never skips over rows that were not written yet
+        async for message in messages:
+            synced_id = max(synced_id, message.id)
+
+            if last_created_at is not None and message.date <= last_created_at:
+                continue
+
+            transaction: dict | None = self.parse(message)
+
+            if transaction is None:
                 app_logger.debug(f"SKIP {message.message}")
                 continue
 
-            if message.date <= to_date:
-                break
+            chunk.append(transaction)
 
-            message_data["id_source"] = 1
-            message_data["created_at"] = message.date
+            if len(chunk) >= config["sync_chunk_size"]:
+                last_transactions.extend(await insert_synced_krc20_transactions(chunk))
+                synced_count += len(chunk)
+                chunk = []
 
-            new_transaction: KRC20Transaction = KRC20Transaction(
-                id_source=message_data["id_source"],
-                ticker=message_data["ticker"],
-                krc20_amount=message_data["krc20_amount"],
-                kas_amount=message_data["kas_amount"],
-                created_at=message_data["created_at"]
-            )
+                app_logger.info(
+                    f"{self.name}: synced {synced_count} transactions up to {message.date}, "
+                    f"{synced_count / (time.perf_counter() - started_at):.0f} rows/s"
+                )
 
-            session.add(new_transaction)
-            await session.flush()
+        if chunk:
+            last_transactions.extend(await insert_synced_krc20_transactions(chunk))
+            synced_count += len(chunk)
 
-            message_data["created_at"] = int(message.date.timestamp() * 1000)
-            if len(last_transactions) < config["last_krc20_transactions_count"]:
-                last_transactions.append(message_data)
+        elapsed: float = time.perf_counter() - started_at
+        app_logger.info(
+            f"{self.name}: finished sync up to message {synced_id}: {synced_count} rows "
+            f"in {elapsed:.1f}s, {synced_count / max(elapsed, 1e-9):.0f} rows/s"
+        )
 
-            app_logger.debug(f"Added new transaction {message.date}")
+        # Every synced trade is already in the per-ticker index, the lists take the newest only
+        await send_krc20_transactions_to_redis(list(last_transactions), add_trades=False)
 
-        await session.commit()
+        return synced_id
 
-        for transaction in reversed(last_transactions):
-            await send_krc20_transaction_to_redis(transaction)
+
+# Channel id -> ingestors reading it
+telegram_ingestors: dict[int, list[TelegramIngestor]] = {}
+for telegram_source in telegram_sources:
+    telegram_ingestors.setdefault(telegram_source.channel_id, []).append(TelegramIngestor(telegram_source))
+
+ingestors: list[Ingestor] = [
+    ingestor for channel_ingestors in telegram_ingestors.values() for ingestor in channel_ingestors
+]
 
 
 async def main():
-    global is_synced
+    start_http_server(config["metrics_port"])
 
     while await redis_client.get("fastapi-core-ready") is None:
         await asyncio.sleep(1)
 
     app_logger.info("App starting..")
 
-    await client.start()
-    await sync_krc20_transactions()
+    await init_krc20_candles()
+
+    for ingestor in ingestors:
+        await ingestor.register()
 
-    await sync_krc20_transactions()
-    is_synced = True
+    await client.start()
+    krc20_writer.start()
 
     app_logger.info("App started successfully")
 
-    await client.run_until_disconnected()
+    # Every source syncs and then goes live on its own, one slow source holds up no other.
+    # A disconnect or a failing ingestor ends the process, the container restarts it.
+    tasks: list[Task] = [asyncio.create_task(client.run_until_disconnected())]
+    tasks += [asyncio.create_task(ingestor.run()) for ingestor in ingestors]
+
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    for task in pending:
+        task.cancel()
 
     app_logger.info("App closed")
 
+    for task in done:
+        task.result()
+
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
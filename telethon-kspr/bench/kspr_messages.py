@@ -0,0 +1,146 @@
+"""
+Throughput of get_message_data on a corpus of KSPR bot messages, against the
+previous three-regex parser:
+
+    python bench/kspr_messages.py --messages 500000
+    python bench/kspr_messages.py --corpus messages.jsonl
+
+A corpus is one JSON string (the message text) per line, e.g. exported from the
+channel; without one a synthetic corpus is generated. --fuzz feeds mutated
+messages to the parser and fails on anything but a dict or None.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from main import get_message_data  # noqa: E402
+
+TICKERS: list[str] = ["NACHO", "KASPY", "KSPR", "GHOAD", "BURT", "KEKE", "KASTOR", "NINJA"]
+
+
+def legacy_get_message_data(message_text: str) -> dict | None:
+    try:
+        ticker: str = re.search(r"Ticker: (.+?)\n", message_text).group(1)
+        krc20_amount: float = float(re.search(r"KRC20 Amount: (.+?)\n", message_text).group(1))
+        kas_amount: float = float(re.search(r"KAS Amount: (.+?)\n", message_text).group(1))
+    except (AttributeError, ValueError):
+        return None
+
+    return {"ticker": ticker, "krc20_amount": krc20_amount, "kas_amount": kas_amount}
+
+
+def generate_message(rng: random.Random) -> str:
+    krc20_amount: float = round(rng.uniform(1, 10_000_000), 2)
+    kas_amount: float = round(rng.uniform(1, 100_000), 2)
+
+    return (
+        f"🟢 New Sale!\n"
+        f"🎟 Ticker: {rng.choice(TICKERS)}\n"
+        f"🪙 KRC20 Amount: {krc20_amount}\n"
+        f"💰 KAS Amount: {kas_amount}\n"
+        f"📈 Price: {kas_amount / krc20_amount:.8f} KAS\n"
+        f"👤 Buyer: kaspa:qr{''.join(rng.choices(string.ascii_lowercase + string.digits, k=58))}\n"
+        f"🔗 Tx Hash: {rng.randbytes(32).hex()}\n"
+        f"\n"
+        f"Trade on KSPR Bot"
+    )
+
+
+def mutate(message: str, rng: random.Random) -> str:
+    chars: list[str] = list(message)
+
+    for _ in range(rng.randint(1, 8)):
+        operation: int = rng.randrange(4)
+        position: int = rng.randrange(len(chars) + 1)
+
+        if operation == 0 and chars:
+            del chars[min(position, len(chars) - 1)]
+        elif operation == 1:
+            chars.insert(position, rng.choice(string.printable + "🟢💰∞ \n:,"))
+        elif operation == 2 and chars:
+            chars[min(position, len(chars) - 1)] = rng.choice(["\n", ":", ",", "nan", "inf", "-", "e9999"])
+        else:
+            chars = chars[:position]
+
+    return "".join(chars)
+
+
+def load_corpus(args: argparse.Namespace) -> list[str]:
+    if args.corpus is not None:
+        with open(args.corpus, encoding="utf-8") as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    rng: random.Random = random.Random(args.seed)
+    return [generate_message(rng) for _ in range(args.messages)]
+
+
+def bench(name: str, parser, corpus: list[str]) -> int:
+    started_at: float = time.perf_counter()
+    parsed: int = sum(1 for message in corpus if parser(message) is not None)
+    elapsed: float = time.perf_counter() - started_at
+
+    print(f"{name:<10}{parsed:>12}{len(corpus) / elapsed:>16,.0f}{elapsed / len(corpus) * 1e6:>12.2f}")
+    return parsed
+
+
+def fuzz(corpus: list[str], iterations: int, seed: int):
+    rng: random.Random = random.Random(seed)
+
+    for _ in range(iterations):
+        message: str = mutate(rng.choice(corpus), rng)
+
+        try:
+            result: dict | None = get_message_data(message)
+        except Exception as exc:
+            raise SystemExit(f"Parser raised {exc!r} on {message!r}")
+
+        if result is not None and (
+                not 0 < len(result["ticker"]) <= 6
+                or not math.isfinite(result["krc20_amount"])
+                or not math.isfinite(result["kas_amount"])
+                or any(len(result.get(key, "x")) > 128 for key in ("buyer", "tx_hash"))
+        ):
+            raise SystemExit(f"Parser accepted an invalid message: {message!r} -> {result}")
+
+    print(f"Fuzz: {iterations} mutated messages, no failures")
+
+
+def main():
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument("--corpus")
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fuzz", type=int, default=0, metavar="ITERATIONS")
+    args: argparse.Namespace = parser.parse_args()
+
+    corpus: list[str] = load_corpus(args)
+
+    # The messages the old parser accepted must still give the same core fields
+    for message in corpus[:10_000]:
+        expected: dict | None = legacy_get_message_data(message)
+        result: dict | None = get_message_data(message)
+
+        if expected is None or len(expected["ticker"]) > 6:
+            continue
+
+        if result is None or any(result[key] != expected[key] for key in expected):
+            raise SystemExit(f"Parsers disagree on {message!r}: {expected} != {result}")
+
+    print(f"{'parser':<10}{'parsed':>12}{'messages/s':>16}{'us/msg':>12}")
+    bench("legacy", legacy_get_message_data, corpus)
+    bench("current", get_message_data, corpus)
+
+    if args.fuzz:
+        fuzz(corpus, args.fuzz, args.seed)
+
+
+if __name__ == "__main__":
+    main()